@@ -1,20 +1,37 @@
 #!/usr/bin/env python3
 
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import functools
+import importlib.util
+import io
 import json
 import os
+import queue
+import re
+import shlex
+import shutil
 import subprocess
+import tempfile
+import threading
 import traceback
 import urllib.request
 import urllib.error
 import time
 import sys
 from dotenv import load_dotenv
-from openai import OpenAI, BadRequestError
+try:
+    import orjson
+except ImportError:
+    orjson = None
+import httpx
+# HTTP/2 lets concurrent requests share one connection, but needs the optional h2 package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 from rich.console import Console
 from rich.markdown import Markdown
-from prompt_toolkit import PromptSession
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.formatted_text import ANSI
+from rich.markup import escape
 
 LOGO = """
 ╔═══════════════════════════════════════════════════════════╗
@@ -35,45 +52,284 @@ LOGO = """
 # Constants
 DEFAULT_MODEL = "x-ai/grok-4-fast"
 SAFETY_MODEL = "x-ai/grok-4-fast"  # Hardcoded for safety analysis
+SAFETY_EXTRA_BODY = {"reasoning": {"enabled": False}}  # A yes/no verdict gains nothing from thinking tokens
 FAVORITES_FILE = ".melon_favorites.json"
 SETTINGS_FILE = ".melon_settings.json"
 CHATS_DIR = ".melon_chats"
+CHAT_PATH_PREFIX = CHATS_DIR + os.sep  # Chat file paths are this prefix, the chat name and .jsonl
+# Typed prompts can include pasted secrets, so they stay in the home directory rather than a project folder
+INPUT_HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".melon_history")
+# Kept in the home directory so a project folder can't plant verdicts for the commands run in it
+COMMAND_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".melon_cmd_cache.json")
+UPDATE_CACHE_FILE = ".melon_update_cache.json"
 DEFAULT_CHAT_NAME = "default"
 CURRENT_VERSION = "0.2.3"
 GITHUB_REPO = "NateSpencerWx/melon"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+UPDATE_CHECK_TTL = 6 * 60 * 60  # Seconds a GitHub release lookup is reused before asking again
+REFRESH_UPDATE = os.environ.get("MELON_REFRESH_UPDATE") == "1"  # Ignore the cached release lookup
+COMMAND_TIMEOUT = 60  # Seconds before a running command is killed
+MAX_OUTPUT_CHARS = 32 * 1024  # Characters kept from each end of a command's output for the model
+OUTPUT_READ_SIZE = 8192  # Longest chunk read from a command at once, so huge lines stay bounded
+STREAM_FLUSH_INTERVAL = 0.05  # Seconds between terminal flushes while a response streams
+TPS_UPDATE_INTERVAL = 0.5  # Seconds between live TPS display updates (and stall checks)
+STALL_TIP_DELAY = 5.0  # Seconds without tokens before suggesting a different model
+MAX_PARALLEL_TOOL_CALLS = 8  # Tool calls from one response run concurrently up to this limit
+MAX_HISTORY_MESSAGES = 40  # Most recent messages sent to the model with each request
+MAX_HISTORY_TOKENS = 32000  # Estimated token budget for the history sent with each request
+MAX_TOOL_MESSAGE_CHARS = 8192  # Tool results longer than this are shortened in the history
+TOOL_MESSAGE_EDGE_CHARS = 3072  # Characters kept from each end of shortened command output
+HISTORY_SUMMARY_MAX_TOKENS = 512  # Length of the summary that stands in for turns trimmed from requests
+HISTORY_SUMMARY_SLICE = 20  # Most trimmed messages folded into the summary by one request
+HISTORY_SUMMARY_MESSAGE_CHARS = 2000  # Characters of each message sent to be summarized
+HISTORY_SUMMARY_TIMEOUT = 60  # Seconds before a summary request gives up
+HISTORY_SUMMARY_RETRY_DELAY = 60  # Seconds to wait after a failed summary before trying again
+MAX_REPEATED_TOOL_CALLS = 3  # Identical tool call batches in a row before the turn is stopped
+FAST_ACK = os.environ.get("MELON_FAST_ACK") == "1"  # Skip the confirmation turn after silent successful commands
+SAFETY_MAX_TOKENS = 128  # Enough for the verdict and a one-line description
+SAFETY_TIMEOUT = 15  # Seconds before a safety review gives up and the command needs approval
+SAFETY_CONCURRENCY = 4  # Background safety reviews (and pooled connections) in flight at once
+SAFETY_CACHE_SIZE = 512  # AI safety verdicts remembered across sessions
+SAFETY_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds before a remembered verdict is asked again
+SAFETY_BATCH_WINDOW = 0.025  # Seconds to wait for more commands before sending a safety review
+SAFETY_BATCH_SIZE = 16  # Most commands reviewed by one safety model request
+SEPARATOR = "[dim]" + "─" * 60 + "[/dim]\n"  # Printed between turns and menus
+
+# ANSI escape codes for output written straight to the terminal
+ANSI_RESET = "\033[0m"
+ANSI_RED = "\033[91m"
+ANSI_GRAY = "\033[90m"
+ANSI_CYAN = "\033[96m"
+ANSI_CLEAR_LINE = "\r\033[K"
+STUCK_RESPONSE_TIP = (
+    "\n\033[93m💡 Tip: If the response seems stuck, the model might be reasoning or processing. Try:\n"
+    "   • Waiting a bit longer (some models take time to think)\n"
+    "   • Simplifying your request\n"
+    "   • Trying a different model (^O to switch)\033[0m\n"
+)
+
+# Sent first in every request. It never changes, so providers can serve it from
+# their prompt cache; keep anything per-turn out of it.
+SYSTEM_PROMPT = (
+    "Your name is Melon, an AI assistant. "
+    "In addition to your native capabilities, you have the ability to run terminal commands on the user's computer if needed to help complete/address the user's request/query. "
+    "Commands are automatically reviewed: read-only commands execute immediately, but commands that modify the system (write, delete, install, etc.) will prompt the user for approval before execution. "
+    "Do not worry about asking for permission - the review system handles this automatically. Just focus on fulfilling the user's request using the tool calls available to you. "
+    "If a user denies a command, acknowledge it gracefully and offer alternatives or ask how they'd like to proceed. "
+    "Additional background information: "
+    "You live in the terminal, inside a command line interface, where the user interacts with you. The name of the interface is the same as your name, Melon. "
+    "If the user is asking you about Melon, check out its public repository on GitHub (NateSpencerWx/melon) for more information."
+)
+
+# Accepted spellings for typed choices
+MODEL_LIST_TARGETS = frozenset({"?", "list"})
+REASONING_ON_WORDS = frozenset({"on", "enable", "enabled"})
+REASONING_OFF_WORDS = frozenset({"off", "disable", "disabled"})
+APPROVE_CHOICES = frozenset({"a", "accept"})
+DENY_CHOICES = frozenset({"d", "deny"})
+EDIT_CHOICES = frozenset({"e", "edit"})
+
+# Local command safety classification, used before falling back to the AI
+# Programs that only read whatever their arguments (find's actions are checked separately);
+# tree -o, date -s, hostname NAME and file -C write, so those programs go to the AI
+READ_ONLY_COMMANDS = frozenset({
+    "ls", "pwd", "cat", "head", "tail", "grep", "find", "ps", "df", "du", "stat", "which",
+    "echo", "wc", "whoami", "id", "uname", "uptime", "free",
+    "basename", "dirname", "realpath", "readlink", "diff", "cut", "tr",
+    "rg", "type", "printenv", "whereis", "nproc", "nl", "cmp", "md5sum", "sha1sum", "sha256sum",
+})
+READ_ONLY_GIT_SUBCOMMANDS = frozenset({"status", "log", "diff", "show", "blame", "rev-parse", "ls-files", "describe", "shortlog"})
+MODIFYING_COMMANDS = frozenset({
+    "rm", "rmdir", "mv", "cp", "ln", "install", "apt", "apt-get", "brew", "pip", "pip3",
+    "npm", "yarn", "chmod", "chown", "mkdir", "touch", "dd", "tee", "truncate", "shred",
+    "sudo", "kill", "pkill", "killall",
+})
+MODIFYING_GIT_SUBCOMMANDS = frozenset({
+    "add", "commit", "push", "pull", "merge", "rebase", "reset", "checkout", "switch",
+    "restore", "rm", "mv", "clean", "stash", "cherry-pick", "revert", "tag", "clone", "init",
+})
+AWK_COMMANDS = frozenset({"awk", "gawk", "mawk", "nawk"})
+# ripgrep options that only change what is searched or how matches are shown; anything else
+# (--pre, --hostname-bin, ...) may run another program, so the command needs an AI review
+RG_SAFE_SHORT_FLAGS = frozenset("aABcCdeEfFgHhiIjlLmMnNopPqrsStTuUvVwxz0")
+RG_SHORT_FLAGS_WITH_VALUE = frozenset("ABCdeEfgjmMrtT")
+RG_SAFE_LONG_FLAGS = frozenset({
+    "after-context", "before-context", "context", "regexp", "file", "glob", "iglob", "type",
+    "type-not", "max-count", "max-depth", "max-filesize", "max-columns", "encoding", "replace",
+    "threads", "sort", "sortr", "color", "colors", "context-separator", "field-match-separator",
+    "ignore-case", "smart-case", "case-sensitive", "line-number", "no-line-number",
+    "files-with-matches", "files-without-match", "count", "count-matches", "word-regexp",
+    "line-regexp", "invert-match", "fixed-strings", "type-list", "hidden", "no-ignore",
+    "no-ignore-vcs", "no-ignore-dot", "no-ignore-parent", "follow", "files", "json", "vimgrep",
+    "only-matching", "heading", "no-heading", "with-filename", "no-filename", "multiline",
+    "multiline-dotall", "pcre2", "stats", "trim", "unrestricted", "text", "binary", "null",
+    "quiet", "column", "byte-offset", "passthru", "max-columns-preview", "search-zip", "crlf",
+    "no-messages", "pretty", "help", "version", "one-file-system",
+})
+RG_LONG_FLAGS_WITH_VALUE = frozenset({
+    "after-context", "before-context", "context", "regexp", "file", "glob", "iglob", "type",
+    "type-not", "max-count", "max-depth", "max-filesize", "max-columns", "encoding", "replace",
+    "threads", "sort", "sortr", "color", "colors", "context-separator", "field-match-separator",
+})
+FIND_ACTION_FLAGS = frozenset({"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"})
+COMMAND_SEPARATORS = frozenset({"|", "|&", "||", "&&", ";", "&", ";;"})
+SHELL_PUNCTUATION = frozenset("();<>|&")
+# Characters that mean a command needs a real shell: operators, expansions, globs, escapes and comments
+SHELL_FEATURE_CHARS = frozenset("|&;<>()$`\\*?[]{}~#!\n")
+
+# Serializes approval prompts so concurrent tool calls don't interleave on stdin
+APPROVAL_LOCK = threading.Lock()
+
+# Terminal escape sequences (colors, cursor movement) stripped from command output
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]")
+
+# Shell variable assignments like FOO=bar, which prefix the real command
+ASSIGNMENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+# Assignments that only change locale or time zone; any other variable (GIT_CONFIG_*,
+# LD_PRELOAD, PAGER, ...) can make a read-only program run code, so it needs an AI review
+HARMLESS_ASSIGNMENT_RE = re.compile(r"(?:LC_[A-Z]+|LANG|LANGUAGE|TZ)=")
+# sed scripts made only of commands that print, delete or substitute, each after an optional
+# address; anything else (w, W, e, r, s///w, s///e, odd delimiters) needs an AI review
+SED_ADDRESS = r"(?:\d+(?:~\d+)?|\$|/(?:[^/\\\n]|\\.)*/[IM]*)"
+SED_SAFE_SCRIPT_RE = re.compile(
+    rf"[\s;]*(?:(?:{SED_ADDRESS}(?:\s*,\s*(?:{SED_ADDRESS}|[+~]\d+))?\s*)?(?:!\s*)?"
+    r"(?:[pPdDqQnNgGhHxlz={}]|s/(?:[^/\\\n]|\\.)*/(?:[^/\\\n]|\\.)*/[gpIiMm0-9]*|y/(?:[^/\\\n]|\\.)*/(?:[^/\\\n]|\\.)*/)"
+    r"[\s;]*)*"
+)
+# awk programs that run commands, read other input, redirect output or pull in
+# code with gawk's @include/@load
+AWK_UNSAFE_RE = re.compile(r"system|getline|[>|@]")
+
+# Errors from providers that reject tool calls in the message history
+TOOL_HISTORY_ERROR_RE = re.compile(r"invalid argument|provider returned error", re.IGNORECASE)
+
+# Characters replaced when an id is used in a file name
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^\w.-]")
+
+# Characters dropped from AI-generated chat names, after quotes are removed and spaces become hyphens
+CHAT_NAME_INVALID_CHARS_RE = re.compile(r"[^a-z0-9\-]")
+CHAT_NAME_TRANSLATION = str.maketrans({'"': None, "'": None, " ": "-"})
+
+# Arguments that look like a subcommand ('run', 'install', 'compose') rather than a path or value
+SUBCOMMAND_RE = re.compile(r"[a-z][a-z0-9-]*$")
+
+# Shared terminal output, used by main and by the helpers that report problems
+console = Console()
+
+# Decodes JSON objects embedded in model replies
+JSON_DECODER = json.JSONDecoder()
+
+# Background AI safety reviews that are still in flight, keyed by command
+SAFETY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SAFETY_CONCURRENCY, thread_name_prefix="melon-safety")
+_pending_analyses = {}
+_pending_analyses_lock = threading.Lock()
+# Reviews waiting to be gathered into one batched request, and the thread gathering them
+_review_queue = queue.Queue()
+_review_coalescer = None
+
+# Background history summaries, kept apart so they never hold up safety reviews
+SUMMARY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="melon-summary")
+
+# Finished AI safety verdicts, most recently used last
+_verdict_cache = collections.OrderedDict()
+_verdict_cache_lock = threading.Lock()
+_verdict_cache_dirty = False
+# Shapes of commands found to modify the system, mapped to the command that was reviewed;
+# guarded by _verdict_cache_lock
+_modifying_shapes = collections.OrderedDict()
+
+# Parsed settings and favorites, kept in sync by the save functions
+_settings_cache = None
+_favorites_cache = None
+# Set once the chats directory is known to exist
+_chats_dir_ready = False
+# Parsed chat histories, keyed by file path and checked against the file's mtime and size
+_history_cache = {}
+# Message counts for chats shown in the chat switcher, checked the same way
+_message_count_cache = {}
+# Files holding full tool output that was truncated for the model, removed at exit
+_saved_output_files = []
+
+def json_loads(data):
+    """Parse JSON text or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    """
+    Serialize an object to compact JSON with sorted keys, using orjson when it is installed.
+    Both paths give the same text, so a message re-sent to the model is byte-identical
+    and stays inside the provider's prompt cache.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def json_dumps_pretty(obj):
+    """Serialize an object to 2-space indented UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode()
 
 def parse_version(version_string):
     """Parse a version string like 'v0.2.0' or '0.2.0' into a tuple of integers."""
-    # Remove 'v' prefix if present
-    version_string = version_string.lstrip('v')
     try:
-        return tuple(int(part) for part in version_string.split('.'))
+        # Remove a single 'v' prefix if present
+        return tuple(map(int, version_string.removeprefix('v').split('.')))
     except (ValueError, AttributeError):
         return (0, 0, 0)
 
-def check_for_updates():
+def load_cached_release():
+    """Return the latest release tag from the update cache, or None if it is missing or stale"""
+    try:
+        with open(UPDATE_CACHE_FILE, 'rb') as f:
+            cached = json_loads(f.read())
+        checked_at = cached["checked_at"]
+        latest_version = cached["latest_version"]
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(checked_at, (int, float)) or not isinstance(latest_version, str):
+        return None
+    if time.time() - checked_at > UPDATE_CHECK_TTL:
+        return None
+    return latest_version
+
+def save_cached_release(latest_version):
+    """Remember the latest release tag so the next few startups skip the GitHub request"""
+    try:
+        atomic_write(UPDATE_CACHE_FILE, json_dumps({"checked_at": time.time(), "latest_version": latest_version}).encode())
+    except OSError:
+        # Without the cache the next startup just asks GitHub again
+        pass
+
+def check_for_updates(refresh=False):
     """
     Check GitHub for the latest release and compare with current version.
+    A lookup from the last UPDATE_CHECK_TTL seconds is reused unless refresh is set.
     Returns (has_update, latest_version, error_message)
     """
     try:
-        url = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
-        req = urllib.request.Request(url)
-        req.add_header('Accept', 'application/vnd.github.v3+json')
-        req.add_header('User-Agent', 'Melon-CLI')
-        
-        with urllib.request.urlopen(req, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            latest_version = data.get('tag_name', '')
-            
-            # Parse versions for comparison
-            current = parse_version(CURRENT_VERSION)
-            latest = parse_version(latest_version)
+        latest_version = None if refresh else load_cached_release()
+        if latest_version is None:
+            url = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
+            req = urllib.request.Request(url)
+            req.add_header('Accept', 'application/vnd.github.v3+json')
+            req.add_header('User-Agent', 'Melon-CLI')
             
-            # Check if latest is newer than current
-            if latest > current:
-                return True, latest_version, None
-            return False, latest_version, None
+            with urllib.request.urlopen(req, timeout=5) as response:
+                data = json.loads(response.read().decode())
+            latest_version = data.get('tag_name', '')
+            save_cached_release(latest_version)
+        
+        # Parse versions for comparison
+        current = parse_version(CURRENT_VERSION)
+        latest = parse_version(latest_version)
+        
+        # Check if latest is newer than current
+        if latest > current:
+            return True, latest_version, None
+        return False, latest_version, None
             
     except urllib.error.URLError as e:
         # Network error - silently fail to not interrupt user experience
@@ -84,106 +340,131 @@ def check_for_updates():
 
 def display_update_notification(latest_version):
     """Display a notification about available update."""
-    print(f"\033[93m🎉 A new version of Melon is available: {CURRENT_VERSION} -> {latest_version}\033[0m")
-    print(f"\033[93mTo update, run: pip install --upgrade git+https://github.com/{GITHUB_REPO}.git\033[0m\n")
+    console.print(
+        f"[yellow]🎉 A new version of Melon is available: {CURRENT_VERSION} -> {escape(latest_version)}\n"
+        f"To update, run: pip install --upgrade git+https://github.com/{GITHUB_REPO}.git[/yellow]\n",
+        soft_wrap=True
+    )
+
+def atomic_write(path, data: bytes):
+    """
+    Replace a file's contents through a synced temporary file in the same
+    directory, so a crash leaves either the old file or the new one, never a
+    truncated mix. The temporary file is removed if anything fails.
+    """
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, path)
+    except BaseException:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
 
 def load_settings():
     """Load settings from file with error recovery"""
+    global _settings_cache
+    if _settings_cache is not None:
+        return dict(_settings_cache)
+    
     default_settings = {"reasoning_enabled": False, "active_chat": DEFAULT_CHAT_NAME}
     try:
-        if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r') as f:
-                settings = json.load(f)
-                # Validate structure
-                if not isinstance(settings, dict):
-                    raise ValueError("Settings file contains invalid data structure")
-                # Ensure required keys exist
-                if "reasoning_enabled" not in settings:
-                    settings["reasoning_enabled"] = False
-                if "active_chat" not in settings:
-                    settings["active_chat"] = DEFAULT_CHAT_NAME
-                return settings
+        with open(SETTINGS_FILE, 'rb') as f:
+            settings = json_loads(f.read())
+        # Validate structure
+        if not isinstance(settings, dict):
+            raise ValueError("Settings file contains invalid data structure")
+        # Ensure required keys exist
+        if "reasoning_enabled" not in settings:
+            settings["reasoning_enabled"] = False
+        if "active_chat" not in settings:
+            settings["active_chat"] = DEFAULT_CHAT_NAME
+        _settings_cache = dict(settings)
+        return settings
+    except FileNotFoundError:
+        _settings_cache = dict(default_settings)
         return default_settings
     except json.JSONDecodeError as e:
         # File is corrupted - backup and recreate
-        print(f"\033[93m⚠️  Settings file corrupted ({e}). Creating backup and resetting...\033[0m")
+        console.print(f"[yellow]⚠️  Settings file corrupted ({escape(str(e))}). Creating backup and resetting...[/yellow]")
         try:
             backup_file = f"{SETTINGS_FILE}.backup"
             if os.path.exists(SETTINGS_FILE):
                 os.rename(SETTINGS_FILE, backup_file)
-                print(f"\033[92m✓ Corrupted file backed up to {backup_file}\033[0m")
+                console.print(f"[green]✓ Corrupted file backed up to {escape(backup_file)}[/green]")
         except Exception as backup_error:
-            print(f"\033[91m⚠️  Failed to backup corrupted settings file: {backup_error}\033[0m")
+            console.print(f"[red]⚠️  Failed to backup corrupted settings file: {escape(str(backup_error))}[/red]")
         return default_settings
     except (OSError, PermissionError) as e:
-        print(f"\033[93m⚠️  Cannot read settings file: {e}. Using defaults.\033[0m")
+        console.print(f"[yellow]⚠️  Cannot read settings file: {escape(str(e))}. Using defaults.[/yellow]")
         return default_settings
     except Exception as e:
-        print(f"\033[93m⚠️  Unexpected error loading settings: {e}. Using defaults.\033[0m")
+        console.print(f"[yellow]⚠️  Unexpected error loading settings: {escape(str(e))}. Using defaults.[/yellow]")
         return default_settings
 
 def save_settings(settings):
     """Save settings to file with error handling"""
+    global _settings_cache
     try:
         # Validate input
         if not isinstance(settings, dict):
             raise ValueError("Settings must be a dictionary")
         
-        # Write to temporary file first
-        temp_file = f"{SETTINGS_FILE}.tmp"
-        with open(temp_file, 'w') as f:
-            json.dump(settings, f, indent=2)
-        
-        # If successful, replace the original file
-        os.replace(temp_file, SETTINGS_FILE)
+        atomic_write(SETTINGS_FILE, json_dumps_pretty(settings))
+        _settings_cache = dict(settings)
         return True
     except (OSError, PermissionError) as e:
-        print(f"\033[91m❌ Cannot save settings: {e}\033[0m")
+        console.print(f"[red]❌ Cannot save settings: {escape(str(e))}[/red]")
         return False
     except Exception as e:
-        print(f"\033[91m❌ Unexpected error saving settings: {e}\033[0m")
-        # Clean up temp file if it exists
-        try:
-            temp_file = f"{SETTINGS_FILE}.tmp"
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-        except Exception as cleanup_error:
-            print(f"\033[93m⚠️  Failed to remove temp file {temp_file}: {cleanup_error}\033[0m")
+        console.print(f"[red]❌ Unexpected error saving settings: {escape(str(e))}[/red]")
         return False
 
 def load_favorites():
     """Load favorite models from file with error recovery"""
+    global _favorites_cache
+    if _favorites_cache is not None:
+        return list(_favorites_cache)
+    
     try:
-        if os.path.exists(FAVORITES_FILE):
-            with open(FAVORITES_FILE, 'r') as f:
-                favorites = json.load(f)
-                # Validate structure
-                if not isinstance(favorites, list):
-                    raise ValueError("Favorites file contains invalid data structure (expected list)")
-                # Validate each item is a string
-                favorites = [str(fav) for fav in favorites if fav]
-                return favorites
+        with open(FAVORITES_FILE, 'rb') as f:
+            favorites = json_loads(f.read())
+        # Validate structure
+        if not isinstance(favorites, list):
+            raise ValueError("Favorites file contains invalid data structure (expected list)")
+        # Validate each item is a string
+        favorites = [str(fav) for fav in favorites if fav]
+        _favorites_cache = list(favorites)
+        return favorites
+    except FileNotFoundError:
+        _favorites_cache = []
         return []
     except json.JSONDecodeError as e:
         # File is corrupted - backup and recreate
-        print(f"\033[93m⚠️  Favorites file corrupted ({e}). Creating backup and resetting...\033[0m")
+        console.print(f"[yellow]⚠️  Favorites file corrupted ({escape(str(e))}). Creating backup and resetting...[/yellow]")
         try:
             backup_file = f"{FAVORITES_FILE}.backup"
             if os.path.exists(FAVORITES_FILE):
                 os.rename(FAVORITES_FILE, backup_file)
-                print(f"\033[92m✓ Corrupted file backed up to {backup_file}\033[0m")
+                console.print(f"[green]✓ Corrupted file backed up to {escape(backup_file)}[/green]")
         except Exception as backup_error:
-            print(f"\033[93m⚠️  Failed to backup corrupted favorites file: {backup_error}\033[0m")
+            console.print(f"[yellow]⚠️  Failed to backup corrupted favorites file: {escape(str(backup_error))}[/yellow]")
         return []
     except (OSError, PermissionError) as e:
-        print(f"\033[93m⚠️  Cannot read favorites file: {e}. Starting with empty list.\033[0m")
+        console.print(f"[yellow]⚠️  Cannot read favorites file: {escape(str(e))}. Starting with empty list.[/yellow]")
         return []
     except Exception as e:
-        print(f"\033[93m⚠️  Unexpected error loading favorites: {e}. Starting with empty list.\033[0m")
+        console.print(f"[yellow]⚠️  Unexpected error loading favorites: {escape(str(e))}. Starting with empty list.[/yellow]")
         return []
 
 def save_favorites(favorites):
     """Save favorite models to file with error handling"""
+    global _favorites_cache
     try:
         # Validate input
         if not isinstance(favorites, list):
@@ -192,88 +473,104 @@ def save_favorites(favorites):
         # Ensure all items are strings
         favorites = [str(fav) for fav in favorites if fav]
         
-        # Write to temporary file first
-        temp_file = f"{FAVORITES_FILE}.tmp"
-        with open(temp_file, 'w') as f:
-            json.dump(favorites, f, indent=2)
-        
-        # If successful, replace the original file
-        os.replace(temp_file, FAVORITES_FILE)
+        atomic_write(FAVORITES_FILE, json_dumps_pretty(favorites))
+        _favorites_cache = list(favorites)
         return True
     except (OSError, PermissionError) as e:
-        print(f"\033[91m❌ Cannot save favorites: {e}\033[0m")
+        console.print(f"[red]❌ Cannot save favorites: {escape(str(e))}[/red]")
         return False
     except Exception as e:
-        print(f"\033[91m❌ Unexpected error saving favorites: {e}\033[0m")
-        # Clean up temp file if it exists
-        try:
-            temp_file = f"{FAVORITES_FILE}.tmp"
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-        except Exception as cleanup_error:
-            print(f"\033[93m⚠️  Could not remove temporary file {temp_file}: {cleanup_error}\033[0m")
+        console.print(f"[red]❌ Unexpected error saving favorites: {escape(str(e))}[/red]")
         return False
 
 def get_chat_file(chat_name):
     """Get the file path for a specific chat"""
-    # Ensure chats directory exists
-    if not os.path.exists(CHATS_DIR):
+    return f"{CHAT_PATH_PREFIX}{chat_name}.jsonl"
+
+def get_file_version(path):
+    """Return a file's (mtime, size) to tell whether it changed, or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def history_lines(messages):
+    """Encode messages as JSON Lines, one message per line"""
+    return b"".join(json_dumps(message).encode() + b"\n" for message in messages)
+
+def ensure_chats_dir():
+    """Create the chats directory the first time a chat is written"""
+    global _chats_dir_ready
+    if not _chats_dir_ready:
         os.makedirs(CHATS_DIR, exist_ok=True)
-    return os.path.join(CHATS_DIR, f"{chat_name}.json")
+        _chats_dir_ready = True
 
 def migrate_old_history():
     """Migrate old .melon_history.json to new multi-chat format"""
     old_history_file = ".melon_history.json"
     if os.path.exists(old_history_file):
         try:
-            with open(old_history_file, 'r') as f:
-                old_history = json.load(f)
+            with open(old_history_file, 'rb') as f:
+                old_history = json_loads(f.read())
             
             # Save to default chat
             if old_history and isinstance(old_history, list):
                 save_history(old_history, DEFAULT_CHAT_NAME)
-                print(f"\033[92m✓ Migrated old conversation history to '{DEFAULT_CHAT_NAME}' chat\033[0m")
+                console.print(f"[green]✓ Migrated old conversation history to '{DEFAULT_CHAT_NAME}' chat[/green]")
             
             # Rename old file as backup
             backup_file = f"{old_history_file}.backup"
             os.rename(old_history_file, backup_file)
-            print(f"\033[92m✓ Old history file backed up to {backup_file}\033[0m\n")
+            console.print(f"[green]✓ Old history file backed up to {escape(backup_file)}[/green]\n")
         except Exception as e:
-            print(f"\033[93m⚠️  Could not migrate old history: {e}\033[0m")
+            console.print(f"[yellow]⚠️  Could not migrate old history: {escape(str(e))}[/yellow]")
 
-def list_chats():
-    """List all available chats"""
-    if not os.path.exists(CHATS_DIR):
-        return []
+def migrate_json_chats():
+    """Convert chats saved as a single JSON array (.json) to the JSON Lines format (.jsonl)"""
     try:
-        chats = []
-        for filename in os.listdir(CHATS_DIR):
-            if filename.endswith('.json'):
-                chat_name = filename[:-5]  # Remove .json extension
-                chats.append(chat_name)
-        return sorted(chats)
-    except Exception:
+        with os.scandir(CHATS_DIR) as entries:
+            legacy_files = [entry.path for entry in entries if entry.name.endswith('.json')]
+    except OSError:
+        return
+    for legacy_file in legacy_files:
+        chat_file = f"{legacy_file}l"
+        if os.path.exists(chat_file):
+            # Both formats exist, so either may hold messages the other lacks; leave them for the user
+            console.print(f"[yellow]⚠️  Not converting '{escape(legacy_file)}': '{escape(chat_file)}' already exists. Merge or remove one of them.[/yellow]")
+            continue
+        try:
+            with open(legacy_file, 'rb') as f:
+                history = json_loads(f.read())
+            if not isinstance(history, list):
+                raise ValueError("expected a list of messages")
+            atomic_write(chat_file, history_lines(history))
+            os.remove(legacy_file)
+        except (OSError, ValueError) as e:
+            console.print(f"[yellow]⚠️  Could not convert chat file '{escape(legacy_file)}': {escape(str(e))}[/yellow]")
+
+def list_chats_with_mtime():
+    """List (chat name, modification time) for all chats with one directory scan"""
+    try:
+        with os.scandir(CHATS_DIR) as entries:
+            return [
+                (entry.name[:-6], entry.stat(follow_symlinks=False).st_mtime)  # Remove .jsonl extension
+                for entry in entries
+                if entry.name.endswith('.jsonl')
+            ]
+    except OSError:
         return []
 
-def get_most_recent_chat(chats):
-    """Get the most recently created/modified chat from a list of chat names"""
+def list_chats():
+    """List all available chats"""
+    return sorted(name for name, _ in list_chats_with_mtime())
+
+def get_most_recent_chat():
+    """Get the most recently created/modified chat, or None if there are no chats"""
+    chats = list_chats_with_mtime()
     if not chats:
         return None
-    try:
-        chat_files = []
-        for chat_name in chats:
-            chat_file = get_chat_file(chat_name)
-            if os.path.exists(chat_file):
-                mtime = os.path.getmtime(chat_file)
-                chat_files.append((chat_name, mtime))
-        
-        if chat_files:
-            # Sort by modification time, newest first
-            chat_files.sort(key=lambda x: x[1], reverse=True)
-            return chat_files[0][0]
-        return chats[0]  # Fallback to first chat if timestamps unavailable
-    except Exception:
-        return chats[0] if chats else None
+    return max(chats, key=lambda chat: chat[1])[0]
 
 def load_history(chat_name=None):
     """Load conversation history from a specific chat file with error recovery"""
@@ -283,36 +580,75 @@ def load_history(chat_name=None):
     chat_file = get_chat_file(chat_name)
     
     try:
-        if os.path.exists(chat_file):
-            with open(chat_file, 'r') as f:
-                history = json.load(f)
-                # Validate structure
-                if not isinstance(history, list):
-                    raise ValueError("History file contains invalid data structure (expected list)")
-                # Validate each message has required fields
-                for msg in history:
-                    if not isinstance(msg, dict) or 'role' not in msg:
-                        raise ValueError("Invalid message format in history")
-                return history
-        return []
+        version = get_file_version(chat_file)
+        if version is None:
+            return []
+        cached = _history_cache.get(chat_file)
+        if cached is not None and cached[0] == version:
+            return list(cached[1])
+        
+        with open(chat_file, 'rb') as f:
+            lines = f.read().splitlines()
+        history = []
+        complete = True
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                history.append(json_loads(line))
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise
+                # A save interrupted mid-append leaves a partial last line; the next save rewrites the file
+                complete = False
+        # Validate each message has required fields, stopping at the first bad one
+        if any(not isinstance(msg, dict) or 'role' not in msg for msg in history):
+            raise ValueError("Invalid message format in history")
+        if complete:
+            _history_cache[chat_file] = (version, list(history))
+        return history
     except json.JSONDecodeError as e:
         # File is corrupted - backup and recreate
-        print(f"\033[93m⚠️  Chat '{chat_name}' corrupted ({e}). Creating backup and resetting...\033[0m")
+        console.print(f"[yellow]⚠️  Chat '{escape(chat_name)}' corrupted ({escape(str(e))}). Creating backup and resetting...[/yellow]")
         try:
             backup_file = f"{chat_file}.backup"
             if os.path.exists(chat_file):
                 os.rename(chat_file, backup_file)
-                print(f"\033[92m✓ Corrupted file backed up to {backup_file}\033[0m")
+                console.print(f"[green]✓ Corrupted file backed up to {escape(backup_file)}[/green]")
         except Exception as backup_error:
-            print(f"\033[93m⚠️  Failed to back up corrupted chat file '{chat_file}': {backup_error}\033[0m")
+            console.print(f"[yellow]⚠️  Failed to back up corrupted chat file '{escape(chat_file)}': {escape(str(backup_error))}[/yellow]")
         return []
     except (OSError, PermissionError) as e:
-        print(f"\033[93m⚠️  Cannot read chat '{chat_name}': {e}. Starting with empty history.\033[0m")
+        console.print(f"[yellow]⚠️  Cannot read chat '{escape(chat_name)}': {escape(str(e))}. Starting with empty history.[/yellow]")
         return []
     except Exception as e:
-        print(f"\033[93m⚠️  Unexpected error loading chat '{chat_name}': {e}. Starting with empty history.\033[0m")
+        console.print(f"[yellow]⚠️  Unexpected error loading chat '{escape(chat_name)}': {escape(str(e))}. Starting with empty history.[/yellow]")
         return []
 
+def chat_message_count(chat_name):
+    """
+    Count a chat's messages without parsing them: a cached history is measured
+    directly, and otherwise the non-empty lines of the file are counted.
+    Counts are cached against the file's mtime and size.
+    """
+    chat_file = get_chat_file(chat_name)
+    version = get_file_version(chat_file)
+    if version is None:
+        return 0
+    cached = _history_cache.get(chat_file)
+    if cached is not None and cached[0] == version:
+        return len(cached[1])
+    cached = _message_count_cache.get(chat_file)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    try:
+        with open(chat_file, 'rb') as f:
+            count = sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+    _message_count_cache[chat_file] = (version, count)
+    return count
+
 def save_history(history, chat_name=None):
     """Save conversation history to a specific chat file with error handling"""
     if chat_name is None:
@@ -325,55 +661,41 @@ def save_history(history, chat_name=None):
         if not isinstance(history, list):
             raise ValueError("History must be a list")
         
-        # Write to temporary file first
-        temp_file = f"{chat_file}.tmp"
-        with open(temp_file, 'w') as f:
-            json.dump(history, f, indent=2)
-        
-        # If successful, replace the original file
-        os.replace(temp_file, chat_file)
+        ensure_chats_dir()
+        # The file holds one message per line, so when it still matches what was last
+        # saved and the history only grew, just the new messages are appended
+        cached = _history_cache.get(chat_file)
+        saved = cached[1] if cached is not None and cached[0] == get_file_version(chat_file) else None
+        if saved is not None and len(history) >= len(saved) and all(a is b for a, b in zip(saved, history)):
+            if len(history) > len(saved):
+                with open(chat_file, 'ab') as f:
+                    f.write(history_lines(history[len(saved):]))
+                    f.flush()
+                    os.fsync(f.fileno())
+        else:
+            atomic_write(chat_file, history_lines(history))
+        _history_cache[chat_file] = (get_file_version(chat_file), list(history))
         return True
     except (OSError, PermissionError) as e:
         # Silently fail for history saving to not interrupt user flow
         return False
     except Exception as e:
-        # Clean up temp file if it exists
-        try:
-            temp_file = f"{chat_file}.tmp"
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-        except Exception as cleanup_error:
-            print(f"\033[93m⚠️  Failed to clean up temp file '{temp_file}': {cleanup_error}\033[0m")
         return False
 
 def delete_chat(chat_name):
     """Delete a specific chat"""
     chat_file = get_chat_file(chat_name)
     try:
-        if os.path.exists(chat_file):
-            os.remove(chat_file)
-            return True, f"Chat '{chat_name}' deleted"
+        os.remove(chat_file)
+        return True, f"Chat '{chat_name}' deleted"
+    except FileNotFoundError:
         return False, f"Chat '{chat_name}' not found"
     except Exception as e:
         return False, f"Error deleting chat: {e}"
 
-def rename_chat(old_name, new_name):
-    """Rename a chat"""
-    if new_name == DEFAULT_CHAT_NAME:
-        return False, f"Cannot use '{DEFAULT_CHAT_NAME}' as a name"
-    
-    old_file = get_chat_file(old_name)
-    new_file = get_chat_file(new_name)
-    
-    try:
-        if not os.path.exists(old_file):
-            return False, f"Chat '{old_name}' not found"
-        if os.path.exists(new_file):
-            return False, f"Chat '{new_name}' already exists"
-        os.rename(old_file, new_file)
-        return True, f"Chat renamed from '{old_name}' to '{new_name}'"
-    except Exception as e:
-        return False, f"Error renaming chat: {e}"
+def has_user_messages(messages):
+    """Check whether a conversation has any user messages, stopping at the first one"""
+    return any(m.get("role") == "user" for m in messages)
 
 def save_unsaved_chat(is_new_unsaved_chat, messages, client, settings):
     """
@@ -388,9 +710,7 @@ def save_unsaved_chat(is_new_unsaved_chat, messages, client, settings):
     Returns:
         tuple: (success: bool, chat_name: str or None, error: str or None)
     """
-    import time
-    
-    if not is_new_unsaved_chat or len([m for m in messages if m.get("role") == "user"]) == 0:
+    if not is_new_unsaved_chat or not has_user_messages(messages):
         return False, None, "No unsaved chat with user messages"
     
     try:
@@ -415,22 +735,19 @@ def save_unsaved_chat(is_new_unsaved_chat, messages, client, settings):
 
 
 
-def generate_chat_name(messages, client, current_name=None):
+def generate_chat_name(messages, client):
     """
     Use AI to generate a descriptive name for a chat based on the first user message.
     Returns a short, descriptive name (2-4 words max).
     This is called when a new chat is created to name it based on the first user message. It is not used for dynamic renaming.
     """
     try:
-        # Get user messages to understand the topic
-        user_messages = [msg for msg in messages if msg.get("role") == "user"]
-        if not user_messages:
+        # Use only the FIRST user message for naming (not recent messages)
+        first_message = next((msg for msg in messages if msg.get("role") == "user"), None)
+        if first_message is None:
             # Fallback to timestamp-based name
-            import time
             return f"chat-{int(time.time())}"
         
-        # Use only the FIRST user message for naming (not recent messages)
-        first_message = user_messages[0]
         context = first_message.get("content", "")[:300]  # Use more of the first message
         
         response = client.chat.completions.create(
@@ -456,146 +773,794 @@ def generate_chat_name(messages, client, current_name=None):
         # Clean up the response
         name = response.choices[0].message.content.strip().lower()
         # Remove any quotes, extra spaces, and ensure it's a valid filename
-        name = name.replace('"', '').replace("'", '').replace(' ', '-')
+        name = name.translate(CHAT_NAME_TRANSLATION)
         # Remove any invalid characters
-        import re
-        name = re.sub(r'[^a-z0-9\-]', '', name)
+        name = CHAT_NAME_INVALID_CHARS_RE.sub('', name)
         # Limit length
         name = name[:50]
         
-        # Don't check uniqueness if we're renaming the current chat
-        # (the current name will be freed up)
-        if current_name != name:
-            chats = list_chats()
-            # Remove current_name from the list if it exists (we're renaming it)
-            if current_name and current_name in chats:
-                chats = [c for c in chats if c != current_name]
-            
-            if name in chats:
-                import time
-                name = f"{name}-{int(time.time()) % 10000}"
+        # Don't overwrite an existing chat
+        if os.path.exists(get_chat_file(name)):
+            name = f"{name}-{int(time.time()) % 10000}"
         
         return name if name else f"chat-{int(time.time())}"
     except Exception as e:
         # Fallback to timestamp-based name
-        import time
         return f"chat-{int(time.time())}"
 
 
-def is_command_modifying(command: str, client) -> tuple[bool, str]:
+def split_command_segments(command: str) -> list[list[str]] | None:
     """
-    Use AI to determine if a command modifies the system and get a description.
-    Returns (is_modifying, description)
+    Tokenize a shell command and split it into the simple commands joined by
+    pipes, &&, ||, ; or &. Returns None if the command can't be tokenized.
     """
     try:
-        # Enable reasoning for safety analysis to improve accuracy
-        response = client.chat.completions.create(
-            model=SAFETY_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a command safety analyzer. Your job is to determine if a shell command will modify the system (write, delete, install, update, etc.) or just read information.\n"
-                        "Respond with a JSON object in this exact format:\n"
-                        "{\n"
-                        '  "modifies": true/false,\n'
-                        '  "description": "Brief description of what the command does"\n'
-                        "}\n"
-                        "Commands that MODIFY include: write operations, file creation/deletion, installations, updates, permission changes, network operations that send data, etc.\n"
-                        "Commands that are READ-ONLY include: listing files, reading file contents, checking status, viewing information, etc."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Analyze this command: {command}"
-                }
-            ],
-            extra_body={"reasoning": {"effort": "high"}}
-        )
+        lexer = shlex.shlex(command.replace("\n", ";"), posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        tokens = list(lexer)
+    except ValueError:
+        return None
+    
+    segments = [[]]
+    for token in tokens:
+        if token in COMMAND_SEPARATORS:
+            segments.append([])
+        else:
+            segments[-1].append(token)
+    return [segment for segment in segments if segment]
+
+def strip_command_wrappers(tokens: list[str]) -> list[str] | None:
+    """
+    Remove leading locale and time zone assignments and wrappers that just run
+    another command (env, nice, nohup, time, timeout), so the real program is first.
+    Returns None if a wrapper is used in a way that can't be followed, or if
+    another variable is set, since the environment can change what a program runs.
+    """
+    while tokens:
+        program = tokens[0]
+        if ASSIGNMENT_RE.match(program):
+            if not HARMLESS_ASSIGNMENT_RE.match(program):
+                return None
+            tokens = tokens[1:]
+        elif program == "env":
+            tokens = tokens[1:]
+            while tokens and tokens[0].startswith("-"):
+                if tokens[0] in ("-S", "--split-string") or tokens[0].startswith("--split-string="):
+                    return None
+                tokens = tokens[2:] if tokens[0] in ("-u", "--unset", "-C", "--chdir") else tokens[1:]
+        elif program == "nice":
+            tokens = tokens[1:]
+            if tokens and tokens[0] == "-n":
+                tokens = tokens[2:]
+            elif tokens and tokens[0].startswith("-"):
+                tokens = tokens[1:]
+        elif program in ("nohup", "time"):
+            tokens = tokens[1:]
+            if program == "time" and tokens and tokens[0] == "-p":
+                tokens = tokens[1:]
+        elif program == "timeout":
+            tokens = tokens[1:]
+            while tokens and tokens[0].startswith("-"):
+                tokens = tokens[2:] if tokens[0] in ("-s", "-k") else tokens[1:]
+            # Skip the duration
+            tokens = tokens[1:]
+        else:
+            break
+    return tokens
+
+def sed_scripts(args: list[str]) -> list[str] | None:
+    """
+    Find the scripts a sed command runs: its -e/--expression values, or else
+    its first operand. Returns None if a script comes from a file or the
+    arguments can't be followed.
+    """
+    scripts = []
+    operands = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--":
+            operands.extend(args[i + 1:])
+            break
+        if arg.startswith("--"):
+            name, has_value, value = arg.partition("=")
+            if name in ("--file", "--line-length"):
+                return None
+            if name == "--expression":
+                if not has_value:
+                    i += 1
+                    if i == len(args):
+                        return None
+                    value = args[i]
+                scripts.append(value)
+        elif arg.startswith("-") and arg != "-":
+            for j, flag in enumerate(arg[1:], 2):
+                if flag in "fl":
+                    return None
+                if flag == "e":
+                    # The script is the rest of this argument, or else the next one
+                    value = arg[j:]
+                    if not value:
+                        i += 1
+                        if i == len(args):
+                            return None
+                        value = args[i]
+                    scripts.append(value)
+                    break
+        else:
+            operands.append(arg)
+        i += 1
+    if not scripts:
+        if not operands:
+            return None
+        scripts.append(operands[0])
+    return scripts
+
+def rg_flags_are_safe(args: list[str]) -> bool:
+    """Check that a ripgrep command only uses options from the RG_SAFE_* allowlists"""
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == "--":
+            break
+        if arg.startswith("--"):
+            name, has_value, _ = arg[2:].partition("=")
+            if name not in RG_SAFE_LONG_FLAGS:
+                return False
+            if name in RG_LONG_FLAGS_WITH_VALUE and not has_value:
+                i += 1
+        elif arg.startswith("-") and arg != "-":
+            for j, flag in enumerate(arg[1:], 2):
+                if flag not in RG_SAFE_SHORT_FLAGS:
+                    return False
+                if flag in RG_SHORT_FLAGS_WITH_VALUE:
+                    # The value is the rest of this argument, or else the next one
+                    if j == len(arg):
+                        i += 1
+                    break
+    return True
+
+def awk_program(args: list[str]) -> str | None:
+    """
+    Find the program text an awk command runs. Only -F and -v are allowed
+    before it; any other option (gawk's -f, -o, -d, -p, --load, ...) can load
+    code or write files, so None is returned and the command needs an AI review.
+    """
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--":
+            i += 1
+            break
+        if not arg.startswith("-") or arg == "-":
+            break
+        if arg[:2] not in ("-F", "-v"):
+            return None
+        # The value is the rest of this argument, or else the next one
+        i += 1 if len(arg) > 2 else 2
+    if i >= len(args):
+        return None
+    return args[i]
+
+def classify_command_locally(command: str, claimed_read_only: bool | None = None) -> tuple[bool, str] | None:
+    """
+    Classify a command without calling the AI, using the program names it runs
+    and any output redirection. The model's read-only claim never widens what is
+    trusted: only known read-only programs pass, and a claim of False sends even
+    those to the AI review.
+    Returns (is_modifying, description), or None if the command is ambiguous
+    and needs an AI review.
+    """
+    # MELON_LLM_SAFETY=1 sends every command to the AI, as older versions did
+    if os.environ.get("MELON_LLM_SAFETY") == "1":
+        return None
+    # Command substitution can run anything, so leave it to the AI
+    if "`" in command or "$(" in command:
+        return None
+    segments = split_command_segments(command)
+    if not segments:
+        return None
+    
+    ambiguous = False
+    for tokens in segments:
+        # Look for redirection, ignoring redirects to /dev/null or other descriptors
+        for i, token in enumerate(tokens):
+            if not set(token) <= SHELL_PUNCTUATION:
+                continue
+            if "(" in token or ")" in token:
+                return None
+            if ">" in token:
+                target = tokens[i + 1] if i + 1 < len(tokens) else ""
+                if target != "/dev/null" and not (token.endswith("&") and target.isdigit()):
+                    return True, "Redirects output into a file"
         
-        # Parse the JSON response
-        response_text = response.choices[0].message.content.strip()
-        # Extract JSON from markdown code blocks if present
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
+        tokens = strip_command_wrappers(tokens)
+        if tokens is None:
+            ambiguous = True
+            continue
+        if not tokens:
+            # Only variable assignments or a bare wrapper like 'env', which just prints
+            continue
         
-        result = json.loads(response_text)
-        return result.get("modifies", True), result.get("description", "No description available")
+        program = tokens[0]
+        # A path like /bin/rm or ./script could be anything
+        if "/" in program:
+            ambiguous = True
+            continue
+        if program in MODIFYING_COMMANDS:
+            return True, f"Runs '{program}', which can modify the system"
+        if program == "git" and len(tokens) > 1:
+            if tokens[1] in MODIFYING_GIT_SUBCOMMANDS:
+                return True, f"Runs 'git {tokens[1]}', which modifies the repository"
+            if tokens[1] in READ_ONLY_GIT_SUBCOMMANDS and not any(token.startswith("--output") for token in tokens):
+                continue
+        if program == "find":
+            if any(token in FIND_ACTION_FLAGS for token in tokens[1:]):
+                ambiguous = True
+            continue
+        if program == "sed":
+            flags = [token for token in tokens[1:] if token.startswith("-") and not token.startswith("--")]
+            if any(token.startswith("--in-place") for token in tokens[1:]) or any("i" in flag for flag in flags):
+                return True, "Runs 'sed -i', which edits files in place"
+            # Scripts read from a file, or using anything beyond print, delete and substitute, could write or run anything
+            scripts = sed_scripts(tokens[1:])
+            if scripts is None or not all(SED_SAFE_SCRIPT_RE.fullmatch(script) for script in scripts):
+                ambiguous = True
+            continue
+        if program == "rg":
+            if not rg_flags_are_safe(tokens[1:]):
+                ambiguous = True
+            continue
+        if program in AWK_COMMANDS:
+            awk_source = awk_program(tokens[1:])
+            if awk_source is None or AWK_UNSAFE_RE.search(awk_source):
+                ambiguous = True
+            continue
+        if program not in READ_ONLY_COMMANDS:
+            ambiguous = True
+    
+    if ambiguous or claimed_read_only is False:
+        return None
+    return False, "Read-only command"
+
+def parse_json_object(text: str) -> dict:
+    """
+    Parse a JSON object from model output.
+    Bare JSON is parsed directly; otherwise decoding starts at the first '{',
+    which skips markdown fences or any other text around the object.
+    """
+    try:
+        result = json_loads(text)
+    except ValueError:
+        start = text.find("{")
+        if start == -1:
+            raise
+        result, _ = JSON_DECODER.raw_decode(text, start)
+    if not isinstance(result, dict):
+        raise ValueError("Expected a JSON object")
+    return result
+
+SAFETY_SYSTEM_PROMPT = (
+    "You are a command safety analyzer. Your job is to determine if a shell command will modify the system (write, delete, install, update, etc.) or just read information.\n"
+    "Commands that MODIFY include: write operations, file creation/deletion, installations, updates, permission changes, network operations that send data, etc.\n"
+    "Commands that are READ-ONLY include: listing files, reading file contents, checking status, viewing information, etc.\n"
+)
+
+def command_shape(command: str) -> str | None:
+    """
+    Reduce a command to its programs, subcommands and flags, with other
+    arguments replaced by '_', so 'rm -r build' and 'rm -r dist' match.
+    Returns None if the command can't be tokenized.
+    """
+    segments = split_command_segments(command)
+    if not segments:
+        return None
+    shapes = []
+    for tokens in segments:
+        shape = [tokens[0]]
+        for i, token in enumerate(tokens[1:], 1):
+            if token.startswith("-") or (i == 1 and SUBCOMMAND_RE.match(token)):
+                shape.append(token)
+            else:
+                shape.append("_")
+        shapes.append(" ".join(shape))
+    return " | ".join(shapes)
+
+def get_cached_verdict(command: str) -> tuple[bool, str] | None:
+    """
+    Return the cached AI verdict for a normalized command, if any and not expired.
+    A command with the same shape as one already found to modify the system
+    reuses that verdict, with a description naming the reviewed command rather
+    than its description, which was written about different arguments.
+    Read-only verdicts are only reused for the exact command, since a different
+    argument can make a read-only command modifying.
+    """
+    with _verdict_cache_lock:
+        entry = _verdict_cache.get(command)
+        if entry is not None:
+            is_modifying, description, cached_at = entry
+            if time.time() - cached_at <= SAFETY_CACHE_TTL:
+                _verdict_cache.move_to_end(command)
+                return is_modifying, description
+            del _verdict_cache[command]
+        
+        shape = command_shape(command)
+        original = _modifying_shapes.get(shape)
+        if original is not None:
+            _modifying_shapes.move_to_end(shape)
+            return True, f"Same kind of command as '{original}', which was judged to modify the system"
+        return None
+
+def remember_modifying_shape(command: str):
+    """Record the shape of a command found to modify the system; the caller holds _verdict_cache_lock"""
+    shape = command_shape(command)
+    if shape is None:
+        return
+    _modifying_shapes[shape] = command
+    _modifying_shapes.move_to_end(shape)
+    if len(_modifying_shapes) > SAFETY_CACHE_SIZE:
+        _modifying_shapes.popitem(last=False)
+
+def cache_verdict(command: str, verdict: tuple[bool, str]):
+    """Remember an AI verdict, evicting the least recently used one when full"""
+    global _verdict_cache_dirty
+    with _verdict_cache_lock:
+        _verdict_cache[command] = (*verdict, time.time())
+        _verdict_cache.move_to_end(command)
+        if verdict[0]:
+            remember_modifying_shape(command)
+        if len(_verdict_cache) > SAFETY_CACHE_SIZE:
+            _verdict_cache.popitem(last=False)
+        _verdict_cache_dirty = True
+
+def load_verdict_cache():
+    """
+    Load the modifying verdicts saved by earlier sessions, skipping expired ones
+    and any dated in the future. A saved verdict can only add an approval prompt,
+    never remove one.
+    """
+    try:
+        with open(COMMAND_CACHE_FILE, 'rb') as f:
+            entries = json_loads(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        # The cache only saves time, so a bad file just means starting empty
+        console.print(f"[yellow]⚠️  Ignoring unreadable command cache: {escape(str(e))}[/yellow]")
+        return
+    
+    now = time.time()
+    with _verdict_cache_lock:
+        # Entries are stored least recently used first
+        for entry in entries if isinstance(entries, list) else ():
+            try:
+                command, is_modifying, description, cached_at = entry
+            except (TypeError, ValueError):
+                continue
+            if is_modifying is not True or not isinstance(command, str) or not isinstance(cached_at, (int, float)):
+                continue
+            if 0 <= now - cached_at <= SAFETY_CACHE_TTL:
+                _verdict_cache[command] = (True, str(description), cached_at)
+                remember_modifying_shape(command)
+        while len(_verdict_cache) > SAFETY_CACHE_SIZE:
+            _verdict_cache.popitem(last=False)
+
+def save_verdict_cache():
+    """
+    Save the modifying AI verdicts for the next session, if any were added.
+    Read-only verdicts only last for this session, so a stale or tampered file
+    can never let a command skip approval.
+    """
+    with _verdict_cache_lock:
+        if not _verdict_cache_dirty:
+            return
+        entries = [[command, *entry] for command, entry in _verdict_cache.items() if entry[0]]
+    try:
+        atomic_write(COMMAND_CACHE_FILE, json_dumps(entries).encode())
+    except OSError:
+        # Losing the cache only costs a few repeat reviews next time
+        pass
+
+def parse_verdict(result) -> tuple[bool, str]:
+    """Turn one {"modifies", "description"} object from the safety model into a verdict"""
+    if not isinstance(result, dict):
+        raise ValueError("Expected a JSON object for each command")
+    return result.get("modifies", True) is not False, result.get("description", "No description available")
+
+def analyze_command_with_ai(command: str, client) -> tuple[bool, str]:
+    """
+    Ask the safety model whether a command modifies the system.
+    Verdicts are cached per command; failures raise so they are never cached.
+    Returns (is_modifying, description)
+    """
+    # A yes/no classification needs no reasoning; JSON mode keeps the reply short and fence-free
+    response = client.chat.completions.create(
+        model=SAFETY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": SAFETY_SYSTEM_PROMPT + (
+                    "Respond with a JSON object in this exact format:\n"
+                    "{\n"
+                    '  "modifies": true/false,\n'
+                    '  "description": "Brief description of what the command does"\n'
+                    "}"
+                )
+            },
+            {
+                "role": "user",
+                "content": f"Analyze this command: {command}"
+            }
+        ],
+        response_format={"type": "json_object"},
+        extra_body=SAFETY_EXTRA_BODY,
+        max_tokens=SAFETY_MAX_TOKENS,
+        temperature=0
+    )
+    
+    verdict = parse_verdict(parse_json_object(response.choices[0].message.content))
+    cache_verdict(command, verdict)
+    return verdict
+
+def analyze_commands_with_ai(commands: list[str], client) -> list[tuple[bool, str]]:
+    """
+    Review several commands with a single safety model request.
+    Verdicts are cached per command and returned in the same order.
+    Raises if the reply doesn't contain exactly one verdict per command.
+    """
+    numbered = "\n".join(f"{i}. {command}" for i, command in enumerate(commands, 1))
+    response = client.chat.completions.create(
+        model=SAFETY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": SAFETY_SYSTEM_PROMPT + (
+                    "You will be given a numbered list of commands. Analyze each one on its own.\n"
+                    "Respond with a JSON object in this exact format, with one entry per command in the same order:\n"
+                    "{\n"
+                    '  "results": [\n'
+                    '    {"modifies": true/false, "description": "Brief description of what the command does"}\n'
+                    "  ]\n"
+                    "}"
+                )
+            },
+            {
+                "role": "user",
+                "content": f"Analyze these commands:\n{numbered}"
+            }
+        ],
+        response_format={"type": "json_object"},
+        extra_body=SAFETY_EXTRA_BODY,
+        max_tokens=SAFETY_MAX_TOKENS * len(commands),
+        temperature=0
+    )
+    
+    results = parse_json_object(response.choices[0].message.content).get("results")
+    if not isinstance(results, list) or len(results) != len(commands):
+        raise ValueError(f"Expected {len(commands)} verdicts from the safety model")
+    verdicts = [parse_verdict(result) for result in results]
+    for command, verdict in zip(commands, verdicts):
+        cache_verdict(command, verdict)
+    return verdicts
+
+def normalize_command(command: str) -> str:
+    """Collapse runs of spaces so trivially different spellings share one AI review"""
+    # Newlines separate commands, so only whitespace within each line is collapsed
+    return "\n".join(" ".join(line.split()) for line in command.strip().splitlines())
+
+def is_command_modifying(command: str, client, claimed_read_only: bool | None = None) -> tuple[bool, str]:
+    """
+    Determine if a command modifies the system and get a description.
+    Commands the local classifier can decide skip the AI review entirely.
+    Returns (is_modifying, description)
+    """
+    verdict = classify_command_locally(command, claimed_read_only)
+    if verdict is not None:
+        return verdict
+    
+    command = normalize_command(command)
+    verdict = get_cached_verdict(command)
+    if verdict is not None:
+        return verdict
+    
+    # Join a review that was already started in the background, if any
+    with _pending_analyses_lock:
+        pending = _pending_analyses.get(command)
+    try:
+        if pending is not None:
+            try:
+                return pending.result()
+            except Exception:
+                # A failed batch review falls back to reviewing this command alone
+                pass
+        return analyze_command_with_ai(command, client)
     except Exception as e:
         # If analysis fails, assume it's modifying to be safe
         return True, f"Unable to analyze command (error: {e}). Treating as potentially modifying."
 
-def run_terminal_command(command: str, client=None, console=None):
+def prefetch_tool_call_reviews(tool_calls, client):
+    """Start background AI safety reviews for the commands in these tool calls that need one"""
+    commands = [command_to_review(tool_call) for tool_call in tool_calls]
+    prefetch_command_analyses([command for command in commands if command], client)
+
+def command_to_review(tool_call) -> str | None:
+    """
+    Get the command from a run_terminal_command call if it may need an AI review,
+    or None if it can't be parsed or the local classifier can decide it.
+    """
+    if tool_call["function"]["name"] != "run_terminal_command":
+        return None
+    try:
+        function_args = parse_tool_arguments(tool_call["function"]["arguments"])
+        command = function_args.get("command")
+    except (ValueError, AttributeError):
+        return None
+    if isinstance(command, str) and command and classify_command_locally(command, function_args.get("is_read_only")) is None:
+        return command
+    return None
+
+def review_batch(batch):
+    """
+    Review queued (command, client, future) entries with as few safety model
+    requests as possible and hand each future its verdict, or the error.
+    """
+    by_client = {}
+    for command, client, future in batch:
+        by_client.setdefault(client, []).append((command, future))
+    for client, entries in by_client.items():
+        commands = [command for command, _ in entries]
+        try:
+            if len(commands) == 1:
+                verdicts = [analyze_command_with_ai(commands[0], client)]
+            else:
+                verdicts = analyze_commands_with_ai(commands, client)
+        except Exception as e:
+            # is_command_modifying retries each command on its own
+            for _, future in entries:
+                future.set_exception(e)
+            continue
+        for (_, future), verdict in zip(entries, verdicts):
+            future.set_result(verdict)
+
+def coalesce_safety_reviews():
+    """
+    Gather reviews queued within SAFETY_BATCH_WINDOW of each other into one
+    batch, so commands reported one by one while streaming share a request.
+    Runs for the life of the process.
+    """
+    while True:
+        batch = [_review_queue.get()]
+        deadline = time.monotonic() + SAFETY_BATCH_WINDOW
+        while len(batch) < SAFETY_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_review_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        SAFETY_EXECUTOR.submit(review_batch, batch)
+
+def prefetch_command_analyses(commands: list[str], client):
+    """
+    Queue the AI safety reviews for a turn's commands in the background, so the
+    network round-trip overlaps with other work. Commands queued close together
+    share one request. is_command_modifying picks up the results.
+    """
+    global _review_coalescer
+    to_review = []
+    # Callers pass only commands the local classifier couldn't decide (see command_to_review)
+    for command in commands:
+        command = normalize_command(command)
+        if command not in to_review and get_cached_verdict(command) is None:
+            to_review.append(command)
+    
+    with _pending_analyses_lock:
+        to_review = [command for command in to_review if command not in _pending_analyses]
+        if not to_review:
+            return
+        futures = {command: concurrent.futures.Future() for command in to_review}
+        _pending_analyses.update(futures)
+        for command, future in futures.items():
+            _review_queue.put((command, client, future))
+        if _review_coalescer is None:
+            _review_coalescer = threading.Thread(target=coalesce_safety_reviews, name="melon-safety-batch", daemon=True)
+            _review_coalescer.start()
+    
+    for command, future in futures.items():
+        def forget(done_future, command=command):
+            # Finished reviews live in the verdict cache
+            with _pending_analyses_lock:
+                if _pending_analyses.get(command) is done_future:
+                    del _pending_analyses[command]
+        future.add_done_callback(forget)
+
+def ask_approval(message, default=""):
+    """
+    Read one line for the approval flow with prompt_toolkit, which gives line
+    editing and a pre-filled default, and runs fine from tool worker threads.
+    """
+    from prompt_toolkit.formatted_text import ANSI
+    from prompt_toolkit.shortcuts import prompt as toolkit_prompt
+    
+    return toolkit_prompt(ANSI(message), default=default).strip()
+
+def is_silent_success(result):
+    """Check if a tool result is a successful command that printed nothing"""
+    return result.get("returncode") == 0 and not result.get("output", "").strip()
+
+def split_simple_command(command: str) -> list[str] | None:
+    """
+    Split a command into argv when it uses no shell features, so it can run
+    without spawning a shell. Returns None if the command needs the shell.
+    """
+    if os.name != "posix" or not SHELL_FEATURE_CHARS.isdisjoint(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # A leading VAR=value is an assignment, which only the shell understands
+    if not argv or "=" in argv[0]:
+        return None
+    return argv
+
+def run_terminal_command(command: str, client, console, is_read_only: bool | None = None):
     """
     Run a terminal command with optional review for modifying commands.
-    If client is provided, will check if command is modifying and prompt user for approval.
+    If client is not None, will check if command is modifying and prompt user for approval.
+    is_read_only is the model's own claim; a claim of False always gets an AI review.
+    All output goes through the given Rich console.
     """
     # If we have a client, do the safety check
     if client:
-        is_modifying, description = is_command_modifying(command, client)
+        is_modifying, description = is_command_modifying(command, client, is_read_only)
         
         if is_modifying:
-            # Show the command and description to the user
-            if console:
-                console.print(f"\n[yellow]⚠️  Command requires approval:[/yellow]")
-                console.print(f"[cyan]Command:[/cyan] {command}")
-                console.print(f"[cyan]Description:[/cyan] {description}")
-            else:
-                print(f"\n\033[93m⚠️  Command requires approval:\033[0m")
-                print(f"\033[96mCommand:\033[0m {command}")
-                print(f"\033[96mDescription:\033[0m {description}")
-            
-            # Prompt user for action
-            while True:
-                choice = input("\n\033[95mDo you want to [A]ccept, [D]eny, or [E]dit this command? \033[0m").strip().lower()
+            # Only one approval prompt at a time when tool calls run concurrently
+            with APPROVAL_LOCK:
+                # Show the command and description to the user
+                console.print(
+                    "\n[yellow]⚠️  Command requires approval:[/yellow]\n"
+                    f"[cyan]Command:[/cyan] {escape(command)}\n"
+                    f"[cyan]Description:[/cyan] {escape(description)}"
+                )
                 
-                if choice in ['a', 'accept']:
-                    break  # Proceed with the command
-                elif choice in ['d', 'deny']:
-                    reason = input("\033[95m📝 Why did you deny this command? (This helps the AI adjust): \033[0m").strip()
-                    if reason:
-                        return {"error": f"Command denied by user. Reason: {reason}. Please try a different approach based on this feedback.", "denied": True}
-                    else:
-                        return {"error": "Command denied by user. Please try a different approach.", "denied": True}
-                elif choice in ['e', 'edit']:
-                    new_command = input("\033[95mEnter the modified command: \033[0m").strip()
-                    if new_command:
-                        command = new_command
-                        # Re-check the edited command
-                        is_modifying, description = is_command_modifying(command, client)
-                        if is_modifying:
-                            if console:
-                                console.print(f"\n[yellow]Updated command still requires approval:[/yellow]")
-                                console.print(f"[cyan]Command:[/cyan] {command}")
-                                console.print(f"[cyan]Description:[/cyan] {description}")
+                # Prompt user for action; Ctrl+C or Ctrl+D at any prompt denies the command
+                try:
+                    while True:
+                        choice = ask_approval("\n\033[95mDo you want to [A]ccept, [D]eny, or [E]dit this command? \033[0m").lower()
+                        
+                        if choice in APPROVE_CHOICES:
+                            break  # Proceed with the command
+                        elif choice in DENY_CHOICES:
+                            reason = ask_approval("\033[95m📝 Why did you deny this command? (This helps the AI adjust): \033[0m")
+                            if reason:
+                                return {"error": f"Command denied by user. Reason: {reason}. Please try a different approach based on this feedback.", "denied": True}
                             else:
-                                print(f"\n\033[93mUpdated command still requires approval:\033[0m")
-                                print(f"\033[96mCommand:\033[0m {command}")
-                                print(f"\033[96mDescription:\033[0m {description}")
-                            continue  # Ask again
-                        else:
-                            break  # Edited command is read-only, proceed
-                    else:
-                        print("\033[91mNo command entered. Denying.\033[0m")
-                        reason = input("\033[95m📝 Why did you deny this command? (This helps the AI adjust): \033[0m").strip()
-                        if reason:
-                            return {"error": f"Command denied by user. Reason: {reason}. Please try a different approach based on this feedback.", "denied": True}
+                                return {"error": "Command denied by user. Please try a different approach.", "denied": True}
+                        elif choice in EDIT_CHOICES:
+                            new_command = ask_approval("\033[95mEdit the command: \033[0m", default=command)
+                            if new_command:
+                                command = new_command
+                                # Re-check the edited command
+                                is_modifying, description = is_command_modifying(command, client)
+                                if is_modifying:
+                                    console.print(
+                                        "\n[yellow]Updated command still requires approval:[/yellow]\n"
+                                        f"[cyan]Command:[/cyan] {escape(command)}\n"
+                                        f"[cyan]Description:[/cyan] {escape(description)}"
+                                    )
+                                    continue  # Ask again
+                                else:
+                                    break  # Edited command is read-only, proceed
+                            else:
+                                console.print("[red]No command entered. Denying.[/red]")
+                                reason = ask_approval("\033[95m📝 Why did you deny this command? (This helps the AI adjust): \033[0m")
+                                if reason:
+                                    return {"error": f"Command denied by user. Reason: {reason}. Please try a different approach based on this feedback.", "denied": True}
+                                else:
+                                    return {"error": "Command denied by user. Please try a different approach.", "denied": True}
                         else:
-                            return {"error": "Command denied by user. Please try a different approach.", "denied": True}
-                else:
-                    print("\033[91mInvalid choice. Please enter A, D, or E.\033[0m")
-    
-    # Execute the command
+                            console.print("[red]Invalid choice. Please enter A, D, or E.[/red]")
+                except (KeyboardInterrupt, EOFError):
+                    console.print("[red]Denied.[/red]")
+                    return {"error": "Command denied by user. Please try a different approach.", "denied": True}
+    
+    # Execute the command, streaming its output to the terminal as it arrives
+    popen_kwargs = dict(
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        bufsize=1,
+        # Python only creates non-inheritable fds, so the child gets nothing
+        # beyond its stdio; close_fds=False is one of CPython's conditions for
+        # using posix_spawn instead of fork+exec (an executable given as a path
+        # is another, hence the shutil.which below)
+        close_fds=False
+    )
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
-        output = result.stdout + result.stderr
-        return {"output": output, "returncode": result.returncode}
-    except subprocess.TimeoutExpired:
-        return {"error": "Command timed out after 60 seconds"}
+        process = None
+        argv = split_simple_command(command)
+        # Not an executable on PATH (a builtin, alias or typo), so let the shell handle it
+        executable = shutil.which(argv[0]) if argv is not None else None
+        if executable is not None:
+            try:
+                process = subprocess.Popen(argv, executable=executable, **popen_kwargs)
+            except OSError:
+                process = None
+        if process is None:
+            process = subprocess.Popen(command, shell=True, **popen_kwargs)
     except Exception as e:
         return {"error": str(e)}
+    
+    # Keep only the start and end of the output so memory stays bounded for noisy commands
+    head, head_chars = [], 0
+    tail, tail_chars = collections.deque(), 0
+    dropped = 0
+    # Set once the command is given up on; the reader keeps draining the pipe but drops the rest
+    abandoned = threading.Event()
+    read_errors = []
+    
+    def read_output():
+        nonlocal head_chars, tail_chars, dropped
+        try:
+            for chunk in iter(lambda: process.stdout.readline(OUTPUT_READ_SIZE), ""):
+                if abandoned.is_set():
+                    continue
+                console.out(chunk, end="", highlight=False)
+                if head_chars < MAX_OUTPUT_CHARS:
+                    room = MAX_OUTPUT_CHARS - head_chars
+                    head.append(chunk[:room])
+                    head_chars += len(head[-1])
+                    chunk = chunk[room:]
+                    if not chunk:
+                        continue
+                tail.append(chunk)
+                tail_chars += len(chunk)
+                while tail_chars > MAX_OUTPUT_CHARS:
+                    removed = tail.popleft()
+                    tail_chars -= len(removed)
+                    dropped += len(removed)
+        except Exception as e:
+            read_errors.append(e)
+        finally:
+            process.stdout.close()
+    
+    # Read on a daemon thread and wait with a deadline: a process the command left in the
+    # background (sleep 20 &, a server) can hold the pipe open long after the command itself
+    # exits or is killed, so the end of the output can't be what bounds the wait
+    reader = threading.Thread(target=read_output, daemon=True, name="melon-command-output")
+    reader.start()
+    deadline = time.monotonic() + COMMAND_TIMEOUT
+    returncode = None
+    try:
+        reader.join(COMMAND_TIMEOUT)
+        if not reader.is_alive():
+            try:
+                returncode = process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+    finally:
+        if returncode is None:
+            abandoned.set()
+            process.kill()
+            process.wait()
+    
+    if read_errors:
+        return {"error": str(read_errors[0])}
+    if returncode is None:
+        return {"error": f"Command timed out after {COMMAND_TIMEOUT} seconds"}
+    output = "".join(head)
+    if dropped:
+        output += f"\n...[{dropped} characters truncated]...\n"
+    output += "".join(tail)
+    # Colors and cursor movement are noise to the model
+    output = ANSI_ESCAPE_RE.sub("", output)
+    return {"output": output, "returncode": returncode, "truncated": dropped > 0}
 
 def convert_tool_calls_to_plain_text(messages):
     """
@@ -649,6 +1614,119 @@ def convert_tool_calls_to_plain_text(messages):
     
     return converted_messages
 
+def estimate_tokens(message):
+    """Roughly estimate a message's token count (~4 characters per token)"""
+    chars = len(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or ():
+        chars += len(tool_call["function"]["arguments"])
+    return chars // 4 + 4
+
+def trim_history(messages, max_messages=MAX_HISTORY_MESSAGES, max_tokens=MAX_HISTORY_TOKENS):
+    """
+    Keep the system message plus the most recent messages for an API request,
+    bounded by both message count and estimated tokens.
+    The window always starts at a user message, so tool results are never
+    separated from the assistant message that requested them.
+    """
+    start = max(1, len(messages) - max_messages)
+    tokens = estimate_tokens(messages[0])
+    for i in range(len(messages) - 1, start - 1, -1):
+        tokens += estimate_tokens(messages[i])
+        if tokens > max_tokens:
+            start = i + 1
+            break
+    if start <= 1:
+        return messages
+    
+    for i in range(start, len(messages)):
+        if messages[i].get("role") == "user":
+            return [messages[0]] + messages[i:]
+    # The current turn alone is longer than the window, so keep all of it
+    for i in range(start - 1, 0, -1):
+        if messages[i].get("role") == "user":
+            return [messages[0]] + messages[i:]
+    return messages
+
+def summarize_history(messages, previous_summary, client) -> str:
+    """
+    Condense messages trimmed from API requests, together with the summary of
+    anything trimmed before them, into one short summary. Each message is cut
+    to HISTORY_SUMMARY_MESSAGE_CHARS, so long command output can't bloat the request.
+    """
+    lines = [f"Earlier summary: {previous_summary}"] if previous_summary else []
+    for message in messages:
+        content = message.get("content") or ""
+        for tool_call in message.get("tool_calls") or ():
+            content += f"\n[tool call] {tool_call['function']['arguments']}"
+        if len(content) > HISTORY_SUMMARY_MESSAGE_CHARS:
+            content = content[:HISTORY_SUMMARY_MESSAGE_CHARS] + " ...[cut]"
+        lines.append(f"{message.get('role')}: {content}")
+    
+    response = client.chat.completions.create(
+        model=SAFETY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Summarize this conversation between a user and a terminal assistant so it can continue without it. "
+                    "Keep the user's goals, decisions, file paths, commands that were run and their outcomes. "
+                    "Reply with the summary only."
+                )
+            },
+            {
+                "role": "user",
+                "content": "\n\n".join(lines)
+            }
+        ],
+        extra_body=SAFETY_EXTRA_BODY,
+        max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+        temperature=0,
+        timeout=HISTORY_SUMMARY_TIMEOUT
+    )
+    return (response.choices[0].message.content or "").strip()
+
+def refresh_history_summary(messages, summary, client):
+    """
+    Pick up a finished summary of the turns trim_history drops, and start
+    summarizing newly dropped turns in the background so the work overlaps
+    with the response and the user's typing. Each request folds in at most
+    HISTORY_SUMMARY_SLICE messages, so a long resumed chat catches up over
+    several requests, and a failed request isn't retried for a while.
+    Returns the summary state for messages, which is reset when the chat changes.
+    """
+    if summary is None or summary["messages"] is not messages:
+        summary = {"messages": messages, "covered": 1, "text": None, "future": None, "retry_at": 0}
+    
+    future = summary["future"]
+    if future is not None:
+        if not future.done():
+            return summary
+        summary["future"] = None
+        try:
+            summary["text"], summary["covered"] = future.result()
+        except Exception:
+            # Keep the older summary and try again later
+            summary["retry_at"] = time.monotonic() + HISTORY_SUMMARY_RETRY_DELAY
+            return summary
+    
+    if time.monotonic() < summary["retry_at"]:
+        return summary
+    dropped_end = len(messages) - len(trim_history(messages)) + 1
+    if dropped_end > summary["covered"]:
+        slice_end = min(dropped_end, summary["covered"] + HISTORY_SUMMARY_SLICE)
+        dropped, previous = messages[summary["covered"]:slice_end], summary["text"]
+        summary["future"] = SUMMARY_EXECUTOR.submit(
+            lambda: (summarize_history(dropped, previous, client), slice_end)
+        )
+    return summary
+
+def history_for_request(messages, summary):
+    """Trim messages for an API request, with the summary of trimmed turns after the system message"""
+    window = trim_history(messages)
+    if summary is None or summary["messages"] is not messages or not summary["text"] or window is messages:
+        return window
+    return [window[0], {"role": "system", "content": f"Summary of the earlier conversation: {summary['text']}"}] + window[1:]
+
 tool_definition = {
     "type": "function",
     "function": {
@@ -660,147 +1738,404 @@ tool_definition = {
                 "command": {
                     "type": "string",
                     "description": "The shell command to run."
+                },
+                "is_read_only": {
+                    "type": "boolean",
+                    "description": "True if and only if this command only reads state and performs no writes, installs, deletes, or network sends."
                 }
             },
-            "required": ["command"]
+            "required": ["command", "is_read_only"]
         }
     }
 }
 
-def stream_response_with_tps(stream, console):
+# Built once so every request sends the same tools list
+TOOLS = [tool_definition]
+
+def stream_response_with_tps(stream, console, on_tool_call=None):
     """
     Stream the response while tracking and displaying TPS (tokens per second).
     
     Args:
         stream: The streaming response from the OpenAI API
         console: Rich console for output (reserved for future use)
+        on_tool_call: Optional callback given each tool call as soon as the next
+            one starts streaming, i.e. every tool call except the last
     
     Returns:
         tuple: (full_content, tool_calls, finish_reason)
     """
-    full_content = ""
-    tool_calls = []
+    # Content chunks, joined once at the end
+    content_parts = []
+    # Tool calls by stream index, with their argument fragments joined once each call is complete
+    tool_calls_by_index = {}
+    argument_parts = {}
+    last_index = None
     finish_reason = None
     
     # TPS tracking variables
     token_count = 0
-    start_time = time.time()
+    # A monotonic clock can't jump with wall-clock adjustments mid-stream
+    start_time = time.monotonic()
     last_token_time = start_time
     last_tps_update = start_time
+    last_flush = start_time
+    exact_count = False  # Set once the usage chunk gives the real token count
+    unflushed = False  # Content written to stdout's buffer but not shown yet
     suggestion_shown = False
     has_content = False  # Track if we've received any content
+    # Write straight to the streams in the per-chunk loop instead of going through print()
+    write, flush = sys.stdout.write, sys.stdout.flush
+    write_err, flush_err = sys.stderr.write, sys.stderr.flush
+    # stderr normally writes straight through (and flushes on the \r that starts each
+    # TPS line), so buffer it while streaming and let the explicit flushes decide
+    stderr_mode = None
+    if isinstance(sys.stderr, io.TextIOWrapper):
+        stderr_mode = {"line_buffering": sys.stderr.line_buffering, "write_through": sys.stderr.write_through}
+        sys.stderr.reconfigure(line_buffering=False, write_through=False)
     
     try:
         for chunk in stream:
-            current_time = time.time()
+            current_time = time.monotonic()
+            
+            # The usage chunk comes last and has no choices
+            usage = getattr(chunk, "usage", None)
+            if usage is not None and usage.completion_tokens:
+                token_count = usage.completion_tokens
+                exact_count = True
             
             if not chunk.choices:
                 continue
             
+            # Read each field once; attribute access on the SDK's models isn't free
             choice = chunk.choices[0]
             delta = choice.delta
+            text = delta.content
+            tool_call_deltas = delta.tool_calls
+            chunk_finish_reason = choice.finish_reason
             
             # Track finish reason
-            if choice.finish_reason:
-                finish_reason = choice.finish_reason
+            if chunk_finish_reason:
+                finish_reason = chunk_finish_reason
             
             # Handle content streaming
-            if delta.content:
+            if text:
                 # Print header only when we first receive content
                 if not has_content:
-                    print("\033[96m💬 Response:\033[0m")
+                    write(f"{ANSI_CYAN}💬 Response:{ANSI_RESET}\n")
                     has_content = True
                 
-                full_content += delta.content
-                # Print the content chunk
-                print(delta.content, end='', flush=True)
+                content_parts.append(text)
+                # Print the content chunk; stdout's buffer collects small deltas between
+                # flushes, and every finished line is shown right away, so a stall in the
+                # middle of a line can only hide the part after the last newline
+                write(text)
+                unflushed = True
+                if "\n" in text or current_time - last_flush >= STREAM_FLUSH_INTERVAL:
+                    flush()
+                    unflushed = False
+                    last_flush = current_time
                 
-                # Estimate tokens (rough approximation: ~4 chars per token)
-                # This is approximate but sufficient for TPS display
-                token_count += max(1, len(delta.content) // 4)
+                # Each content chunk is about one token, which is close enough for the
+                # live display; the usage chunk replaces it with the exact count
+                token_count += 1
                 last_token_time = current_time
                 
                 # Reset zero TPS tracking if we got tokens
                 suggestion_shown = False
+            elif unflushed:
+                # A chunk without content (a keepalive or reasoning while the answer
+                # pauses) means the provider has stopped sending text for now
+                flush()
+                unflushed = False
+                last_flush = current_time
             
             # Handle tool calls
-            if delta.tool_calls:
-                for tool_call_delta in delta.tool_calls:
-                    # Find or create the tool call in our list
+            if tool_call_deltas:
+                # Show any buffered text before the arguments start streaming silently
+                if unflushed:
+                    flush()
+                    unflushed = False
+                    last_flush = current_time
+                for tool_call_delta in tool_call_deltas:
+                    # Find or create the tool call for this index
                     idx = tool_call_delta.index
-                    while len(tool_calls) <= idx:
-                        tool_calls.append({
+                    tool_call = tool_calls_by_index.get(idx)
+                    if tool_call is None:
+                        # A new tool call starting means the previous one is complete
+                        if last_index is not None:
+                            previous = tool_calls_by_index[last_index]
+                            previous["function"]["arguments"] = "".join(argument_parts[last_index])
+                            if on_tool_call:
+                                on_tool_call(previous)
+                        tool_call = {
                             "id": "",
                             "type": "function",
                             "function": {"name": "", "arguments": ""}
-                        })
+                        }
+                        tool_calls_by_index[idx] = tool_call
+                        argument_parts[idx] = []
+                        last_index = idx
                     
                     if tool_call_delta.id:
-                        tool_calls[idx]["id"] = tool_call_delta.id
-                    if tool_call_delta.function:
-                        if tool_call_delta.function.name:
-                            tool_calls[idx]["function"]["name"] = tool_call_delta.function.name
-                        if tool_call_delta.function.arguments:
-                            tool_calls[idx]["function"]["arguments"] += tool_call_delta.function.arguments
+                        tool_call["id"] = tool_call_delta.id
+                    function_delta = tool_call_delta.function
+                    if function_delta:
+                        if function_delta.name:
+                            tool_call["function"]["name"] = function_delta.name
+                        if function_delta.arguments:
+                            argument_parts[idx].append(function_delta.arguments)
                 last_token_time = current_time
             
-            # Update TPS display periodically (every 0.5 seconds)
-            if current_time - last_tps_update >= 0.5:
-                elapsed = current_time - start_time
-                if elapsed > 0 and token_count > 0:
-                    tps = token_count / elapsed
-                    # Display TPS on stderr so it doesn't interfere with content
-                    sys.stderr.write(f"\r\033[K\033[90m[TPS: {tps:.1f}]\033[0m")
-                    sys.stderr.flush()
-                last_tps_update = current_time
+            # Most chunks stop at this one comparison; the TPS display and the stall
+            # check only need to run a couple of times a second
+            if current_time - last_tps_update < TPS_UPDATE_INTERVAL:
+                continue
+            last_tps_update = current_time
+            
+            elapsed = current_time - start_time
+            if elapsed > 0 and token_count > 0:
+                tps = token_count / elapsed
+                if unflushed:
+                    flush()
+                    unflushed = False
+                    last_flush = current_time
+                # Display TPS on stderr so it doesn't interfere with content
+                write_err(f"{ANSI_CLEAR_LINE}{ANSI_GRAY}[TPS: {tps:.1f}]{ANSI_RESET}")
+                flush_err()
             
             # Check for zero TPS condition (simplified to 5 seconds total)
-            time_since_last_token = current_time - last_token_time
-            if time_since_last_token > 5.0 and token_count > 0 and not suggestion_shown:
+            if (not suggestion_shown and token_count > 0
+                    and current_time - last_token_time > STALL_TIP_DELAY):
                 # Show suggestion after 5 seconds of zero TPS
-                sys.stderr.write("\n\033[93m💡 Tip: If the response seems stuck, the model might be reasoning or processing. Try:\n")
-                sys.stderr.write("   • Waiting a bit longer (some models take time to think)\n")
-                sys.stderr.write("   • Simplifying your request\n")
-                sys.stderr.write("   • Trying a different model (^O to switch)\033[0m\n")
-                sys.stderr.flush()
+                write_err(STUCK_RESPONSE_TIP)
+                flush_err()
                 suggestion_shown = True
     
     except Exception as e:
-        print(f"\n\033[91m❌ Streaming error: {e}\033[0m")
-        print(f"\033[90m{traceback.format_exc()}\033[0m")
+        write(f"\n{ANSI_RED}❌ Streaming error: {e}{ANSI_RESET}\n")
+        write(f"{ANSI_GRAY}{traceback.format_exc()}{ANSI_RESET}\n")
     
     finally:
         # Cleanup code that should always run
         if has_content:
-            print()  # New line after content
+            write("\n")  # New line after content
+        flush()
         # Clear any remaining TPS display
-        sys.stderr.write("\r\033[K")
-        elapsed = time.time() - start_time
+        write_err(ANSI_CLEAR_LINE)
+        elapsed = time.monotonic() - start_time
         if elapsed > 0 and token_count > 0:
             final_tps = token_count / elapsed
-            sys.stderr.write(f"\033[90m[Final TPS: {final_tps:.1f}, Total tokens: ~{token_count}]\033[0m\n")
-            sys.stderr.flush()
+            approximate = "" if exact_count else "~"
+            write_err(f"{ANSI_GRAY}[Final TPS: {final_tps:.1f}, Total tokens: {approximate}{token_count}]{ANSI_RESET}\n")
+        flush_err()
+        if stderr_mode is not None:
+            sys.stderr.reconfigure(**stderr_mode)
     
-    return full_content, tool_calls, finish_reason
+    tool_calls = []
+    for idx in sorted(tool_calls_by_index):
+        tool_call = tool_calls_by_index[idx]
+        tool_call["function"]["arguments"] = "".join(argument_parts[idx])
+        tool_calls.append(tool_call)
+    return "".join(content_parts), tool_calls, finish_reason
+
+def prewarm_connection(http_client):
+    """Open a pooled connection to OpenRouter so the first request skips the TCP/TLS handshake"""
+    try:
+        http_client.head(f"{OPENROUTER_BASE_URL}/models", timeout=5)
+    except Exception:
+        # Warming is best-effort; the real request will connect on its own
+        pass
+
+def create_openai_client(api_key, timeout, limits):
+    """
+    Build an OpenRouter client on its own connection pool, using HTTP/2 when
+    the h2 package is installed, and start warming its connection in the background.
+    """
+    # openai is by far the slowest import, so it's loaded on first use (see main)
+    from openai import OpenAI, DefaultHttpxClient
+    
+    http_client = DefaultHttpxClient(http2=HTTP2_AVAILABLE, limits=limits)
+    client = OpenAI(
+        base_url=OPENROUTER_BASE_URL,
+        api_key=api_key,
+        timeout=timeout,
+        http_client=http_client
+    )
+    # Establish the pooled connection while the user types their first message
+    threading.Thread(target=prewarm_connection, args=(http_client,), daemon=True).start()
+    return client
+
+def create_clients(api_key):
+    """Create the chat client and the separate safety review client for an API key"""
+    # Keep idle connections alive between turns so follow-up requests reuse them
+    client = create_openai_client(
+        api_key,
+        timeout=3600,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=600)
+    )
+    # Safety reviews get their own small pool so they never queue behind a streaming reply
+    safety_client = create_openai_client(
+        api_key,
+        timeout=SAFETY_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=SAFETY_CONCURRENCY,
+            max_keepalive_connections=SAFETY_CONCURRENCY,
+            keepalive_expiry=600
+        )
+    )
+    return client, safety_client
+
+def validate_api_key(api_key):
+    """
+    Check an OpenRouter API key with the key info endpoint, which generates no tokens.
+    Returns True or False, or None if OpenRouter couldn't be reached.
+    """
+    try:
+        response = httpx.get(
+            f"{OPENROUTER_BASE_URL}/key",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=10
+        )
+    except httpx.HTTPError:
+        return None
+    if response.status_code in (401, 403):
+        return False
+    return True if response.is_success else None
+
+def prompt_for_api_key(console):
+    """
+    Ask the user for an OpenRouter API key, until OpenRouter accepts one,
+    and save it to .env. Returns the key, or None if nothing was entered.
+    """
+    while True:
+        api_key = input("🔑 Enter your OpenRouter API key: ").strip()
+        if not api_key:
+            return None
+        if validate_api_key(api_key) is not False:
+            # An unreachable OpenRouter leaves the check to the first real request
+            break
+        console.print("[red]❌ OpenRouter rejected that API key. Please try again.[/red]")
+    with open('.env', 'w') as f:
+        f.write(f'OPENROUTER_API_KEY={api_key}\n')
+    console.print("[green]✓ API key saved to .env[/green]\n")
+    return api_key
 
 def create_tools_map(client, console):
     """Create a tools map with closures that have access to client and console"""
     return {
-        "run_terminal_command": lambda command: run_terminal_command(command, client, console)
+        "run_terminal_command": lambda command, is_read_only=None: run_terminal_command(command, client, console, is_read_only)
     }
 
+def remove_saved_outputs():
+    """Delete the full-output files saved by tool_message_content during this session"""
+    for path in _saved_output_files:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _saved_output_files.clear()
+
+def tool_message_content(result, tool_call_id):
+    """
+    Serialize a tool result for the conversation history. Long command output is
+    cut down to its start and end, since it's re-sent with every later request;
+    the full output is saved to a temp file the model can read back if needed.
+    """
+    content = json_dumps(result)
+    output = result.get("output")
+    if len(content) <= MAX_TOOL_MESSAGE_CHARS or not isinstance(output, str) or len(output) <= 2 * TOOL_MESSAGE_EDGE_CHARS:
+        return content
+    
+    # mkstemp makes a new file only the user can read, with a name nobody can plant a link at
+    try:
+        fd, path = tempfile.mkstemp(prefix=f"melon-{UNSAFE_FILENAME_CHARS_RE.sub('_', tool_call_id)}-", suffix=".log")
+        _saved_output_files.append(path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(output)
+        saved = f"; full output saved to {path}"
+    except OSError:
+        saved = ""
+    dropped = len(output) - 2 * TOOL_MESSAGE_EDGE_CHARS
+    result = dict(
+        result,
+        output=(
+            output[:TOOL_MESSAGE_EDGE_CHARS]
+            + f"\n...[{dropped} characters truncated{saved}]...\n"
+            + output[-TOOL_MESSAGE_EDGE_CHARS:]
+        ),
+        truncated=True
+    )
+    return json_dumps(result)
+
+@functools.lru_cache(maxsize=256)
+def parse_tool_arguments(arguments: str):
+    """
+    Parse a tool call's JSON arguments. Dedupe, safety review and dispatch all
+    read the same arguments, so each string is only parsed once.
+    Callers must not modify the result. Raises ValueError for invalid JSON.
+    """
+    return json_loads(arguments or "{}")
+
+def tool_call_key(tool_call):
+    """Identify a tool call by its name and canonical arguments, ignoring its id"""
+    function = tool_call["function"]
+    try:
+        arguments = json_dumps(parse_tool_arguments(function["arguments"]))
+    except ValueError:
+        arguments = function["arguments"]
+    return function["name"], arguments
+
+def needs_approval(tool_call, client):
+    """Check if a tool call will stop to ask the user before it runs"""
+    if tool_call["function"]["name"] != "run_terminal_command":
+        return False
+    try:
+        function_args = parse_tool_arguments(tool_call["function"]["arguments"])
+        command = function_args["command"]
+    except (ValueError, TypeError, KeyError):
+        # call_tool reports bad arguments without prompting
+        return False
+    if not isinstance(command, str):
+        return False
+    return is_command_modifying(command, client, function_args.get("is_read_only"))[0]
+
+def call_tool(tools_map, tool_call):
+    """
+    Run one tool call from the model. Bad arguments, unknown tools and
+    exceptions become an error result, so one failing call never aborts
+    the others in the same turn.
+    """
+    function_name = tool_call["function"]["name"]
+    try:
+        function_args = parse_tool_arguments(tool_call["function"]["arguments"])
+    except ValueError as e:
+        return {"error": f"Invalid JSON arguments for {function_name}: {e}"}
+    if function_name not in tools_map:
+        return {"error": f"Unknown tool: {function_name}"}
+    try:
+        return tools_map[function_name](**function_args)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+def numbered_list(items):
+    """Format items as the numbered menu lines the selection prompts refer to"""
+    return "\n".join(f"  [{i}] {escape(item)}" for i, item in enumerate(items, 1))
+
 def handle_model_selection(current_model, console):
     """Handle the model selection interface"""
     favorites = load_favorites()
     
-    console.print("\n[cyan]🤖 Model Selection[/cyan]")
-    console.print(f"[yellow]Current model:[/yellow] {current_model}")
-    console.print("\n[cyan]Options:[/cyan]")
-    console.print("  [1] Enter a model name")
-    console.print("  [2] Select from favorites")
-    console.print("  [3] Add current model to favorites")
-    console.print("  [4] Manage favorites")
-    console.print("  [5] Cancel")
+    console.print(
+        "\n[cyan]🤖 Model Selection[/cyan]\n"
+        f"[yellow]Current model:[/yellow] {escape(current_model)}\n"
+        "\n[cyan]Options:[/cyan]\n"
+        "  [1] Enter a model name\n"
+        "  [2] Select from favorites\n"
+        "  [3] Add current model to favorites\n"
+        "  [4] Manage favorites\n"
+        "  [5] Cancel"
+    )
     
     choice = input("\n\033[95mSelect an option (1-5): \033[0m").strip()
     
@@ -817,9 +2152,7 @@ def handle_model_selection(current_model, console):
             console.print("[yellow]No favorites saved yet. Add some first![/yellow]")
             return current_model
         
-        console.print("\n[cyan]📌 Favorite Models:[/cyan]")
-        for i, fav in enumerate(favorites, 1):
-            console.print(f"  [{i}] {fav}")
+        console.print("\n[cyan]📌 Favorite Models:[/cyan]\n" + numbered_list(favorites))
         
         try:
             fav_choice = int(input("\n\033[95mSelect a favorite (number): \033[0m").strip())
@@ -849,9 +2182,7 @@ def handle_model_selection(current_model, console):
             console.print("[yellow]No favorites to manage[/yellow]")
             return current_model
         
-        console.print("\n[cyan]📌 Manage Favorites:[/cyan]")
-        for i, fav in enumerate(favorites, 1):
-            console.print(f"  [{i}] {fav}")
+        console.print("\n[cyan]📌 Manage Favorites:[/cyan]\n" + numbered_list(favorites))
         console.print("\n[cyan]Enter the number to remove, or 'c' to cancel:[/cyan]")
         
         remove_choice = input("\033[95m> \033[0m").strip().lower()
@@ -883,7 +2214,6 @@ def handle_model_selection(current_model, console):
 
 def process_model_command(command: str, current_model: str, console) -> str:
     """Handle quick model switching via slash commands"""
-    favorites = load_favorites()
     parts = command.split(maxsplit=1)
 
     if len(parts) == 1:
@@ -894,16 +2224,16 @@ def process_model_command(command: str, current_model: str, console) -> str:
     if not target:
         return handle_model_selection(current_model, console)
 
-    if target in {"?", "list"}:
+    if target in MODEL_LIST_TARGETS:
+        favorites = load_favorites()
         if favorites:
-            console.print("\n[cyan]📌 Favorite Models:[/cyan]")
-            for idx, fav in enumerate(favorites, 1):
-                console.print(f"  [{idx}] {fav}")
+            console.print("\n[cyan]📌 Favorite Models:[/cyan]\n" + numbered_list(favorites))
         else:
             console.print("[yellow]No favorites saved yet. Use the model menu to add some.[/yellow]")
         return current_model
 
     if target.isdigit():
+        favorites = load_favorites()
         fav_index = int(target) - 1
         if 0 <= fav_index < len(favorites):
             selected = favorites[fav_index]
@@ -920,9 +2250,9 @@ def toggle_reasoning(settings: dict, console, target_state: str | None = None) -
     """Toggle reasoning setting with optional explicit on/off control"""
     current_state = settings.get("reasoning_enabled", False)
 
-    if target_state in {"on", "enable", "enabled"}:
+    if target_state in REASONING_ON_WORDS:
         new_state = True
-    elif target_state in {"off", "disable", "disabled"}:
+    elif target_state in REASONING_OFF_WORDS:
         new_state = False
     else:
         new_state = not current_state
@@ -936,164 +2266,12 @@ def toggle_reasoning(settings: dict, console, target_state: str | None = None) -
     return settings
 
 
-def handle_chat_management(console, settings):
-    """Handle the chat management interface"""
-    current_chat = settings.get("active_chat", DEFAULT_CHAT_NAME)
-    chats = list_chats()
-    
-    console.print("\n[cyan]💬 Chat Management[/cyan]")
-    console.print(f"[yellow]Current chat:[/yellow] {current_chat}")
-    
-    if chats:
-        console.print("\n[cyan]Available chats:[/cyan]")
-        for i, chat in enumerate(chats, 1):
-            marker = " ← current" if chat == current_chat else ""
-            console.print(f"  [{i}] {chat}{marker}")
-    else:
-        console.print("\n[yellow]No saved chats yet[/yellow]")
-    
-    console.print("\n[cyan]Options:[/cyan]")
-    console.print("  [1] Switch to a different chat")
-    console.print("  [2] Create a new chat")
-    console.print("  [3] Rename a chat")
-    console.print("  [4] Delete a chat")
-    console.print("  [5] Cancel")
-    
-    choice = input("\n\033[95mSelect an option (1-5): \033[0m").strip()
-    
-    if choice == "1":
-        # Switch chat
-        if not chats:
-            console.print("[yellow]No chats available to switch to[/yellow]")
-            return settings
-        
-        console.print("\n[cyan]Select a chat:[/cyan]")
-        for i, chat in enumerate(chats, 1):
-            console.print(f"  [{i}] {chat}")
-        
-        try:
-            chat_choice = int(input("\n\033[95mEnter chat number: \033[0m").strip())
-            if 1 <= chat_choice <= len(chats):
-                selected_chat = chats[chat_choice - 1]
-                settings["active_chat"] = selected_chat
-                if save_settings(settings):
-                    console.print(f"[green]✓ Switched to chat: {selected_chat}[/green]")
-                    console.print("[yellow]⚠️  Please restart Melon to load the new chat[/yellow]")
-                else:
-                    console.print("[red]Failed to save settings[/red]")
-            else:
-                console.print("[red]Invalid selection[/red]")
-        except ValueError:
-            console.print("[red]Invalid input[/red]")
-    
-    elif choice == "2":
-        # Create new chat
-        chat_name = input("\033[95mEnter new chat name: \033[0m").strip()
-        if not chat_name:
-            console.print("[red]Chat name cannot be empty[/red]")
-        elif chat_name in chats:
-            console.print(f"[red]Chat '{chat_name}' already exists[/red]")
-        else:
-            # Create empty chat and switch to it
-            save_history([], chat_name)
-            settings["active_chat"] = chat_name
-            if save_settings(settings):
-                console.print(f"[green]✓ Created and switched to chat: {chat_name}[/green]")
-                console.print("[yellow]⚠️  Please restart Melon to load the new chat[/yellow]")
-            else:
-                console.print("[red]Failed to save settings[/red]")
-    
-    elif choice == "3":
-        # Rename chat
-        if not chats:
-            console.print("[yellow]No chats to rename[/yellow]")
-            return settings
-        
-        console.print("\n[cyan]Select a chat to rename:[/cyan]")
-        for i, chat in enumerate(chats, 1):
-            console.print(f"  [{i}] {chat}")
-        
-        try:
-            chat_choice = int(input("\n\033[95mEnter chat number: \033[0m").strip())
-            if 1 <= chat_choice <= len(chats):
-                old_name = chats[chat_choice - 1]
-                new_name = input(f"\033[95mEnter new name for '{old_name}': \033[0m").strip()
-                if new_name:
-                    success, message = rename_chat(old_name, new_name)
-                    if success:
-                        console.print(f"[green]✓ {message}[/green]")
-                        # Update active chat if it was renamed
-                        if settings.get("active_chat") == old_name:
-                            settings["active_chat"] = new_name
-                            save_settings(settings)
-                    else:
-                        console.print(f"[red]{message}[/red]")
-                else:
-                    console.print("[red]New name cannot be empty[/red]")
-            else:
-                console.print("[red]Invalid selection[/red]")
-        except ValueError:
-            console.print("[red]Invalid input[/red]")
-    
-    elif choice == "4":
-        # Delete chat
-        if not chats:
-            console.print("[yellow]No chats available to delete[/yellow]")
-            return settings
-        
-        console.print("\n[cyan]Select a chat to delete:[/cyan]")
-        for i, chat in enumerate(chats, 1):
-            console.print(f"  [{i}] {chat}")
-        
-        try:
-            chat_choice = int(input("\n\033[95mEnter chat number: \033[0m").strip())
-            if 1 <= chat_choice <= len(chats):
-                chat_name = chats[chat_choice - 1]
-                confirm = input(f"\033[95m⚠️  Delete chat '{chat_name}'? (yes/no): \033[0m").strip().lower()
-                if confirm == "yes":
-                    success, message = delete_chat(chat_name)
-                    if success:
-                        console.print(f"[green]✓ {message}[/green]")
-                        # Switch to most recent chat if we deleted the active chat
-                        if settings.get("active_chat") == chat_name:
-                            # Get remaining chats after deletion
-                            remaining_chats = list_chats()
-                            if remaining_chats:
-                                # Switch to the most recently created chat
-                                new_chat = get_most_recent_chat(remaining_chats)
-                                settings["active_chat"] = new_chat
-                                if save_settings(settings):
-                                    console.print(f"[yellow]Switched to '{new_chat}' chat[/yellow]")
-                                else:
-                                    console.print("[red]Failed to save settings. You may need to restart Melon.[/red]")
-                            else:
-                                # No chats left, create a new default chat
-                                save_history([], DEFAULT_CHAT_NAME)
-                                settings["active_chat"] = DEFAULT_CHAT_NAME
-                                if save_settings(settings):
-                                    console.print(f"[yellow]Created new '{DEFAULT_CHAT_NAME}' chat[/yellow]")
-                                else:
-                                    console.print("[red]Failed to save settings. You may need to restart Melon.[/red]")
-                    else:
-                        console.print(f"[red]{message}[/red]")
-                else:
-                    console.print("[yellow]Deletion cancelled[/yellow]")
-            else:
-                console.print("[red]Invalid selection[/red]")
-        except ValueError:
-            console.print("[red]Invalid input[/red]")
-    
-    elif choice == "5":
-        console.print("[yellow]Cancelled[/yellow]")
-    
-    else:
-        console.print("[red]Invalid option[/red]")
-    
-    return settings
-
-
 def create_input_session():
     """Create a prompt session with Ctrl key bindings"""
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import FileHistory
+    from prompt_toolkit.key_binding import KeyBindings
+    
     kb = KeyBindings()
     
     # Store action that was triggered
@@ -1120,7 +2298,13 @@ def create_input_session():
         KeyAction.action = 'switch_chat'
         event.app.exit(result='__CTRL_S__')
     
-    session = PromptSession(key_bindings=kb)
+    # Keep typed prompts across runs so the up arrow recalls earlier sessions too;
+    # create the file readable only by the user before prompt_toolkit appends to it
+    try:
+        os.close(os.open(INPUT_HISTORY_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600))
+    except OSError:
+        pass
+    session = PromptSession(key_bindings=kb, history=FileHistory(INPUT_HISTORY_FILE))
     return session, KeyAction
 
 
@@ -1145,20 +2329,21 @@ def display_status(console, current_model, settings, active_chat=None):
     console.print(
         f"[bold cyan]Chat[/bold cyan]: {chat_display}    "
         f"[bold cyan]Model[/bold cyan]: {current_model}    "
-        f"[bold cyan]Reasoning[/bold cyan]: {reasoning_label}"
+        f"[bold cyan]Reasoning[/bold cyan]: {reasoning_label}\n"
     )
-    console.print("")
 
 
 def handle_settings(console):
     """Handle the settings interface"""
     settings = load_settings()
     
-    console.print("\n[cyan]⚙️  Settings[/cyan]")
-    console.print(f"[yellow]Reasoning:[/yellow] {'Enabled' if settings.get('reasoning_enabled', False) else 'Disabled'}")
-    console.print("\n[cyan]Options:[/cyan]")
-    console.print("  [1] Toggle reasoning (enable extended thinking for complex queries)")
-    console.print("  [2] Cancel")
+    console.print(
+        "\n[cyan]⚙️  Settings[/cyan]\n"
+        f"[yellow]Reasoning:[/yellow] {'Enabled' if settings.get('reasoning_enabled', False) else 'Disabled'}\n"
+        "\n[cyan]Options:[/cyan]\n"
+        "  [1] Toggle reasoning (enable extended thinking for complex queries)\n"
+        "  [2] Cancel"
+    )
     
     choice = input("\n\033[95mSelect an option: \033[0m").strip()
     
@@ -1193,16 +2378,14 @@ def handle_chat_switch(console, settings, current_chat):
         console.print("[yellow]No chats available[/yellow]")
         return current_chat
     
-    console.print("\n[cyan]💬 Available Chats:[/cyan]")
+    lines = ["\n[cyan]💬 Available Chats:[/cyan]"]
     for i, chat in enumerate(chats, 1):
-        # Load history to get message count
-        history = load_history(chat)
-        msg_count = len(history)
+        msg_count = chat_message_count(chat)
         # Only show current marker if current_chat is not None and matches
         current_marker = " ← current" if current_chat is not None and chat == current_chat else ""
-        console.print(f"  [{i}] {chat} ({msg_count} messages){current_marker}")
-    
-    console.print("\n[dim]Enter number to switch, 'd' + number to delete (e.g., 'd2'), or press Enter to cancel[/dim]")
+        lines.append(f"  [{i}] {escape(chat)} ({msg_count} messages){current_marker}")
+    lines.append("\n[dim]Enter number to switch, 'd' + number to delete (e.g., 'd2'), or press Enter to cancel[/dim]")
+    console.print("\n".join(lines))
     choice = input("\033[95m> \033[0m").strip()
     
     if not choice:
@@ -1225,27 +2408,20 @@ def handle_chat_switch(console, settings, current_chat):
                         console.print(f"[green]✓ {message}[/green]")
                         # If we deleted the current chat, need to switch to another chat
                         if current_chat == chat_to_delete:
-                            # Get remaining chats after deletion
-                            remaining_chats = list_chats()
-                            if remaining_chats:
-                                # Switch to the most recently created chat
-                                new_chat = get_most_recent_chat(remaining_chats)
-                                settings["active_chat"] = new_chat
-                                if save_settings(settings):
-                                    console.print(f"[yellow]Switched to '{new_chat}' chat[/yellow]")
-                                    return new_chat
-                                else:
-                                    console.print("[red]Failed to save settings. You may need to restart Melon.[/red]")
-                                    return new_chat
+                            # Switch to the most recently created chat
+                            new_chat = get_most_recent_chat()
+                            if new_chat:
+                                console.print(f"[yellow]Switched to '{new_chat}' chat[/yellow]")
                             else:
                                 # No chats left, create a new default chat
-                                save_history([], DEFAULT_CHAT_NAME)
-                                settings["active_chat"] = DEFAULT_CHAT_NAME
-                                if save_settings(settings):
-                                    console.print(f"[yellow]Created new '{DEFAULT_CHAT_NAME}' chat[/yellow]")
-                                else:
-                                    console.print("[red]Failed to save settings. You may need to restart Melon.[/red]")
-                                return DEFAULT_CHAT_NAME
+                                new_chat = DEFAULT_CHAT_NAME
+                                save_history([], new_chat)
+                                console.print(f"[yellow]Created new '{new_chat}' chat[/yellow]")
+                            settings["active_chat"] = new_chat
+                            # The caller loads the chat in place, so a failed save only affects the next launch
+                            if not save_settings(settings):
+                                console.print("[red]Failed to save settings[/red]")
+                            return new_chat
                         return current_chat
                     else:
                         console.print(f"[red]{message}[/red]")
@@ -1272,8 +2448,7 @@ def handle_chat_switch(console, settings, current_chat):
                 save_settings(settings)
                 
                 # Load history count for display
-                history = load_history(selected_chat)
-                msg_count = len(history)
+                msg_count = chat_message_count(selected_chat)
                 console.print(f"[green]✓ Switched to '{selected_chat}' ({msg_count} messages)[/green]")
                 return selected_chat
             else:
@@ -1287,6 +2462,13 @@ def handle_chat_switch(console, settings, current_chat):
         return current_chat
 
 
+def with_system_message(system_message, history):
+    """Put the current system message in front of a loaded chat history"""
+    if history and history[0].get("role") == "system":
+        # Replace old system message with current one
+        history = history[1:]
+    return [system_message] + history
+
 def display_chat_history(messages, console):
     """Display previous messages from chat history to the user"""
     # Filter out system messages, tool messages, and assistant messages with tool_calls
@@ -1314,110 +2496,123 @@ def display_chat_history(messages, console):
             console.print("")
     
     console.print("[cyan]═══ End of History ═══[/cyan]\n")
+
+def parse_args(argv=None):
+    """Parse Melon's command line options"""
+    parser = argparse.ArgumentParser(prog="melon", description="Do (almost) anything on your computer with AI.")
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="",
+        metavar="CHAT",
+        help="continue a saved chat instead of starting a new one (default: the most recently used chat)"
+    )
+    return parser.parse_args(argv)
+
 def main():
-    print("\033[91m" + LOGO + "\033[0m")  # Red color
-    console = Console()
+    args = parse_args()
+    # Import the OpenAI SDK and the prompt session while the logo, update check and key loading run
+    slow_imports = threading.Thread(
+        target=lambda: [importlib.import_module(name) for name in ("openai", "prompt_toolkit.shortcuts")],
+        daemon=True
+    )
+    slow_imports.start()
+    console.print(LOGO, style="red", highlight=False)
     
-    # Check for updates on startup
-    has_update, latest_, error = check_for_updates()
-    if has_update and latest_:
-        display_update_notification(latest_)
-    elif not has_update and latest_ and not error:
-        # Successfully checked and no update available
-        print("\033[92m✓ Melon is up to date ({0})\033[0m\n".format(CURRENT_VERSION))
+    # Check for updates in the background; the result is shown before the next prompt
+    update_check = concurrent.futures.Future()
+    threading.Thread(
+        target=lambda: update_check.set_result(check_for_updates(REFRESH_UPDATE)),
+        daemon=True
+    ).start()
     
     load_dotenv()
     api_key = os.getenv('OPENROUTER_API_KEY')
 
     if not api_key:
-        print("\033[93m⚠️  No OpenRouter API key found in .env file.\033[0m")
-        print("\n📋 To get started:")
-        print("   1. Sign up at: \033[94mhttps://openrouter.ai/\033[0m")
-        print("   2. Get your API key from: \033[94mhttps://openrouter.ai/keys\033[0m")
-        print("")
-        print(" 💡You can use credits from other API providers with OpenRouter: \033[94mhttps://openrouter.ai/docs/use-cases/byok\033[0m")
-        print()
-        while True:
-            api_key = input("🔑 Enter your OpenRouter API key: ").strip()
-            if not api_key:
-                print("\033[91m❌ No API key provided. Exiting.\033[0m")
-                return
-            # Validate the API key
-            try:
-                test_client = OpenAI(
-                    base_url="https://openrouter.ai/api/v1",
-                    api_key=api_key,
-                    timeout=10
-                )
-                # Make a test API call to verify the key
-                test_response = test_client.chat.completions.create(
-                    model="openai/gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "Say 'OK' if this works. You ABSOLUTELY MUST respond with only 'OK' if you see this message."}
-                    ],
-                    max_tokens=10
-                )
-                if "OK" not in test_response.choices[0].message.content:
-                    raise Exception(f"Test API call validation failed - received unexpected response: {test_response.choices[0].message.content}")
-                break  # Valid key, exit loop
-            except Exception as e:
-                print(f"\033[91m❌ Invalid API key: {e}\033[0m")
-                print("\033[93m🔄 Please try again.\033[0m")
-                continue
-        with open('.env', 'w') as f:
-            f.write(f'OPENROUTER_API_KEY={api_key}\n')
-        print("\033[92m✓ API key saved to .env\033[0m\n")
+        console.print(
+            "[yellow]⚠️  No OpenRouter API key found in .env file.[/yellow]\n"
+            "\n📋 To get started:\n"
+            "   1. Sign up at: [blue]https://openrouter.ai/[/blue]\n"
+            "   2. Get your API key from: [blue]https://openrouter.ai/keys[/blue]\n"
+            "\n"
+            " 💡You can use credits from other API providers with OpenRouter: [blue]https://openrouter.ai/docs/use-cases/byok[/blue]\n"
+        )
+        api_key = prompt_for_api_key(console)
+        if not api_key:
+            console.print("[red]❌ No API key provided. Exiting.[/red]")
+            return
     else:
-        print("\033[92m✓ API key loaded successfully\033[0m\n")
+        console.print("[green]✓ API key loaded successfully[/green]\n")
 
+    slow_imports.join()
+    from openai import AuthenticationError, BadRequestError
+    from prompt_toolkit.formatted_text import ANSI
+    
     try:
-        client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key,
-            timeout=3600
-        )
+        client, safety_client = create_clients(api_key)
     except Exception as e:
-        print(f"\033[91m❌ Error initializing client: {e}\033[0m")
+        console.print(f"[red]❌ Error initializing client: {escape(str(e))}[/red]")
         return
-
-    # Create tools map with access to client and console
-    tools_map = create_tools_map(client, console)
+    
+    # Create tools map with access to the safety client and console
+    tools_map = create_tools_map(safety_client, console)
 
     # Initialize current model and settings
     current_model = DEFAULT_MODEL
     settings = load_settings()
     
-    # Migrate old single-file history if it exists
+    # Migrate old single-file history and chats saved as JSON arrays
     migrate_old_history()
+    migrate_json_chats()
+    
+    # Reuse safety verdicts from earlier sessions, and keep new ones for the next
+    load_verdict_cache()
+    atexit.register(save_verdict_cache)
+    # Full command output can hold secrets, so it doesn't outlive the session
+    atexit.register(remove_saved_outputs)
 
     # Initialize conversation history with system message
-    system_message = {
-        "role": "system",
-        "content": (
-            "Your name is Melon, an AI assistant. "
-            "In addition to your native capabilities, you have the ability to run terminal commands on the user's computer if needed to help complete/address the user's request/query. "
-            "Commands are automatically reviewed: read-only commands execute immediately, but commands that modify the system (write, delete, install, etc.) will prompt the user for approval before execution. "
-            "Do not worry about asking for permission - the review system handles this automatically. Just focus on fulfilling the user's request using the tool calls available to you. "
-            "If a user denies a command, acknowledge it gracefully and offer alternatives or ask how they'd like to proceed. "
-            "Additional background information: "
-            "You live in the terminal, inside a command line interface, where the user interacts with you. The name of the interface is the same as your name, Melon. "
-            "If the user is asking you about Melon, check out its public repository on GitHub (NateSpencerWx/melon) for more information."
-        )
-    }
+    system_message = {"role": "system", "content": SYSTEM_PROMPT}
     
-    # Start in a new, unsaved chat on every launch
+    # Start in a new, unsaved chat unless --resume asked for a saved one
     messages = [system_message]
     active_chat = None
     is_new_unsaved_chat = True
+    # Background summary of turns that no longer fit in requests
+    history_summary = None
+    if args.resume is not None:
+        chats = list_chats()
+        chat_name = args.resume or get_most_recent_chat()
+        if chat_name in chats:
+            active_chat = chat_name
+            is_new_unsaved_chat = False
+            loaded_history = load_history(active_chat)
+            messages = with_system_message(system_message, loaded_history)
+            console.print(f"[cyan]Resumed chat '{escape(active_chat)}' ({len(messages) - 1} messages)[/cyan]")
+            display_chat_history(loaded_history, console)
+        elif chat_name:
+            console.print(f"[yellow]⚠️  No saved chat named '{escape(chat_name)}'. Starting a new chat.[/yellow]")
+        else:
+            console.print("[yellow]⚠️  No saved chats to resume. Starting a new chat.[/yellow]")
 
-    print("\033[96m💡 Use ^N for new chat, ^S to switch/delete chat, ^O for model, ^R for reasoning. Press ^C to exit.\033[0m")
-    print("\033[90m" + "─" * 60 + "\033[0m\n")
+    console.print("[cyan]💡 Use ^N for new chat, ^S to switch/delete chat, ^O for model, ^R for reasoning. Press ^C to exit.[/cyan]")
+    console.print(SEPARATOR)
     
     # Create prompt session with key bindings
     session, key_action = create_input_session()
     
     while True:
         try:
+            if update_check is not None and update_check.done():
+                has_update, latest_, error = update_check.result()
+                update_check = None
+                if has_update and latest_:
+                    display_update_notification(latest_)
+                elif not has_update and latest_ and not error:
+                    # Successfully checked and no update available
+                    console.print(f"[green]✓ Melon is up to date ({CURRENT_VERSION})[/green]\n")
+            
             display_status(console, current_model, settings, active_chat)
             
             # Use prompt_toolkit session for input with key bindings
@@ -1425,7 +2620,7 @@ def main():
                 user_input = session.prompt(ANSI("\033[95m🍉 \033[0m")).strip()
             except KeyboardInterrupt:
                 # Save unsaved chat before exiting
-                if is_new_unsaved_chat and len([m for m in messages if m.get("role") == "user"]) > 0:
+                if is_new_unsaved_chat and has_user_messages(messages):
                     console.print("\n[cyan]Saving current chat before exiting...[/cyan]")
                     success, chat_name, error = save_unsaved_chat(is_new_unsaved_chat, messages, client, settings)
                     if success:
@@ -1434,11 +2629,11 @@ def main():
                         console.print(f"[green]✓ Saved to '{chat_name}'[/green]")
                     else:
                         console.print(f"[red]✗ Failed to save chat: {error}[/red]")
-                print("\n\033[91m👋 Thanks for using Melon!\033[0m")
+                console.print("\n[red]👋 Thanks for using Melon![/red]")
                 break
             except EOFError:
                 # Save unsaved chat before exiting
-                if is_new_unsaved_chat and len([m for m in messages if m.get("role") == "user"]) > 0:
+                if is_new_unsaved_chat and has_user_messages(messages):
                     console.print("\n[cyan]Saving current chat before exiting...[/cyan]")
                     success, chat_name, error = save_unsaved_chat(is_new_unsaved_chat, messages, client, settings)
                     if success:
@@ -1447,13 +2642,13 @@ def main():
                         console.print(f"[green]✓ Saved to '{chat_name}'[/green]")
                     else:
                         console.print(f"[red]✗ Failed to save chat: {error}[/red]")
-                print("\n\033[91m👋 Thanks for using Melon!\033[0m")
+                console.print("\n[red]👋 Thanks for using Melon![/red]")
                 break
             
             # Check if a keyboard shortcut was triggered
             if user_input == '__CTRL_N__':
                 # Ctrl+N - Create new chat
-                if len([m for m in messages if m.get("role") == "user"]) > 0:  # Has user messages
+                if has_user_messages(messages):
                     console.print("\n[cyan]Saving current chat...[/cyan]")
                     
                     # If the current chat is unsaved, name it now based on first message
@@ -1467,7 +2662,7 @@ def main():
                         else:
                             console.print(f"[red]✗ Failed to save chat: {error}[/red]")
                             console.print("[red]Cannot create new chat until current chat is saved. Please try again.[/red]")
-                            print("\033[90m" + "─" * 60 + "\033[0m\n")
+                            console.print(SEPARATOR)
                             continue
                     else:
                         # Current chat already has a name, just save it
@@ -1479,25 +2674,25 @@ def main():
                 is_new_unsaved_chat = True
                 active_chat = None  # No active chat until first message is sent
                 console.print("[cyan]Starting new chat (will be named after first message)[/cyan]")
-                print("\033[90m" + "─" * 60 + "\033[0m\n")
+                console.print(SEPARATOR)
                 continue
                 
             elif user_input == '__CTRL_O__':
                 # Ctrl+O - Model selection
                 current_model = handle_model_selection(current_model, console)
-                print("\033[90m" + "─" * 60 + "\033[0m\n")
+                console.print(SEPARATOR)
                 continue
                 
             elif user_input == '__CTRL_R__':
                 # Ctrl+R - Toggle reasoning
                 settings = toggle_reasoning(settings, console)
-                print("\033[90m" + "─" * 60 + "\033[0m\n")
+                console.print(SEPARATOR)
                 continue
                 
             elif user_input == '__CTRL_S__':
                 # Ctrl+S - Switch/delete chat
                 # First, handle any unsaved new chat
-                if is_new_unsaved_chat and len([m for m in messages if m.get("role") == "user"]) > 0:
+                if is_new_unsaved_chat and has_user_messages(messages):
                     # Save the current unsaved chat before switching
                     console.print("\n[cyan]Saving current chat before switching...[/cyan]")
                     success, chat_name, error = save_unsaved_chat(is_new_unsaved_chat, messages, client, settings)
@@ -1510,7 +2705,7 @@ def main():
                     else:
                         console.print(f"[red]✗ Failed to save chat: {error}[/red]")
                         console.print("[red]Chat switch cancelled. Please resolve the save issue before switching chats.[/red]")
-                        print("\033[90m" + "─" * 60 + "\033[0m\n")
+                        console.print(SEPARATOR)
                         continue
                 
                 # Now switch to a different chat
@@ -1523,60 +2718,71 @@ def main():
                     is_new_unsaved_chat = False  # We're loading an existing chat
                     loaded_history = load_history(active_chat)
                     
-                    # Merge with system message
-                    if loaded_history and loaded_history[0].get("role") != "system":
-                        messages = [system_message] + loaded_history
-                    else:
-                        # Replace old system message with current one
-                        messages = [system_message] + loaded_history[1:] if loaded_history else [system_message]
+                    messages = with_system_message(system_message, loaded_history)
                     
                     console.print(f"[cyan]Loaded {len([m for m in messages if m.get('role') != 'system'])} messages[/cyan]")
                     
                     # Display the chat history to the user
                     display_chat_history(loaded_history, console)
                 
-                print("\033[90m" + "─" * 60 + "\033[0m\n")
+                console.print(SEPARATOR)
                 continue
             
             if not user_input:
                 continue
 
-            print("\n\033[93mThinking...\033[0m")
+            console.print("\n[yellow]Thinking...[/yellow]")
 
             try:
                 # Add user message to conversation
                 messages.append({"role": "user", "content": user_input})
-                print("\033[96m🤔 Getting a response from Melon...\033[0m")
+                console.print("[cyan]🤔 Getting a response from Melon...[/cyan]")
                 
                 # Handle tool calls in a loop until we get a final response
                 max_iterations = 1000000000000000000000000000000000000000000000000000000000000000000000000000000  # origionaly meant to limit iterations, but it is not useful anymore
                 iteration = 0
+                # Tool call batches from the last few responses, to catch the model looping
+                recent_tool_calls = collections.deque(maxlen=MAX_REPEATED_TOOL_CALLS - 1)
                 
                 while iteration < max_iterations:
+                    history_summary = refresh_history_summary(messages, history_summary, client)
+                    
                     # Build API call parameters
                     api_params = {
                         "model": current_model,
-                        "messages": messages,
-                        "tools": [tool_definition],
-                        "stream": True  # Enable streaming
+                        "messages": history_for_request(messages, history_summary),
+                        "tools": TOOLS,
+                        "stream": True,  # Enable streaming
+                        # The last chunk reports the exact token usage for the TPS summary
+                        "stream_options": {"include_usage": True},
+                        # Let OpenRouter compress the middle of prompts that exceed the model's context
+                        "extra_body": {"transforms": ["middle-out"]}
                     }
                     
                     # Add reasoning if enabled
                     if settings.get('reasoning_enabled', False):
-                        api_params["extra_body"] = {"reasoning": {"effort": "high"}}
+                        api_params["extra_body"]["reasoning"] = {"effort": "high"}
                     
                     try:
                         # Create streaming response
                         stream = client.chat.completions.create(**api_params)
+                    except AuthenticationError:
+                        # The key is only checked here, so ask for a new one and retry the request
+                        console.print("[red]❌ OpenRouter rejected your API key.[/red]")
+                        api_key = prompt_for_api_key(console)
+                        if not api_key:
+                            raise
+                        client, safety_client = create_clients(api_key)
+                        tools_map = create_tools_map(safety_client, console)
+                        continue
                     except BadRequestError as e:
                         # Some models (like Google Gemini) don't support tool calls in message history
                         # Convert to plain text and retry without tools
-                        error_message = str(e)
-                        if "invalid argument" in error_message.lower() or "provider returned error" in error_message.lower():
-                            print("\033[93m⚠️  Model doesn't support tool call format in history. Converting to plain text...\033[0m")
+                        if TOOL_HISTORY_ERROR_RE.search(str(e)):
+                            console.print("[yellow]⚠️  Model doesn't support tool call format in history. Converting to plain text...[/yellow]")
                             
                             # Convert tool call history to plain text
-                            converted_messages = convert_tool_calls_to_plain_text(messages)
+                            converted_messages = convert_tool_calls_to_plain_text(api_params["messages"])
                             
                             # Retry without tools parameter
                             api_params["messages"] = converted_messages
@@ -1588,44 +2794,88 @@ def main():
                             raise
                     
                     # Stream the response with TPS tracking
-                    content, tool_calls_list, finish_reason = stream_response_with_tps(stream, console)
+                    # Each tool call's safety review starts as soon as the call has finished streaming
+                    content, tool_calls_list, finish_reason = stream_response_with_tps(
+                        stream,
+                        console,
+                        on_tool_call=lambda tool_call: prefetch_tool_call_reviews([tool_call], safety_client)
+                    )
                     
                     # Check if there are tool calls
                     if tool_calls_list:
-                        print(f"\033[96m🔧 Melon wants to run some commands: {[tc['function']['name'] for tc in tool_calls_list]}\033[0m")
+                        # Stop if the model keeps asking for exactly the same calls
+                        signature = tuple(tool_call_key(tc) for tc in tool_calls_list)
+                        if len(recent_tool_calls) == recent_tool_calls.maxlen and all(s == signature for s in recent_tool_calls):
+                            console.print("[yellow]⚠️  Melon repeated the same commands several times in a row. Stopping to prevent a loop.[/yellow]")
+                            content = "Detected repeated tool call; aborting to prevent a loop."
+                            messages.append({"role": "assistant", "content": content})
+                            break
+                        recent_tool_calls.append(signature)
                         
-                        # Add assistant message with tool calls to history
+                        # Review whatever wasn't started during streaming in one batched request,
+                        # so it overlaps with the rest of the dispatch
+                        prefetch_tool_call_reviews(tool_calls_list, safety_client)
+                        
+                        console.print(f"[cyan]🔧 Melon wants to run some commands: {escape(str([tc['function']['name'] for tc in tool_calls_list]))}[/cyan]")
+                        
+                        # Add assistant message with tool calls to history; the streamed
+                        # tool calls are already in the message format
                         messages.append({
                             "role": "assistant",
                             "content": content,
-                            "tool_calls": [
-                                {
-                                    "id": tc["id"],
-                                    "type": "function",
-                                    "function": {
-                                        "name": tc["function"]["name"],
-                                        "arguments": tc["function"]["arguments"]
-                                    }
-                                }
-                                for tc in tool_calls_list
-                            ]
+                            "tool_calls": tool_calls_list
                         })
 
-                        for tool_call in tool_calls_list:
-                            print(f"\033[96m⏳ Running: {tool_call['function']['name']}...\033[0m")
-                            function_name = tool_call["function"]["name"]
-                            function_args = json.loads(tool_call["function"]["arguments"])
-                            result = tools_map[function_name](**function_args)
-                            print(f"\033[96m✅ Done!\033[0m")
+                        # Run runs of consecutive read-only tool calls concurrently. A call that needs
+                        # approval waits for the calls before it, so it sees their effects and its
+                        # prompt has the terminal to itself, and the calls after it wait for it.
+                        # Results are recorded in the model's order.
+                        max_workers = min(MAX_PARALLEL_TOOL_CALLS, len(tool_calls_list))
+                        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                            keys = [tool_call_key(tc) for tc in tool_calls_list]
+                            # Identical calls share one run, unless an approved call ran between them
+                            started = {}
+                            futures = []
+                            in_flight = []
+                            for key, tool_call in zip(keys, tool_calls_list):
+                                if key in started:
+                                    futures.append(started[key])
+                                    continue
+                                if needs_approval(tool_call, safety_client):
+                                    concurrent.futures.wait(in_flight)
+                                    in_flight.clear()
+                                    console.print(f"[cyan]⏳ Running: {escape(tool_call['function']['name'])}...[/cyan]")
+                                    future = concurrent.futures.Future()
+                                    future.set_result(call_tool(tools_map, tool_call))
+                                    started.clear()
+                                else:
+                                    console.print(f"[cyan]⏳ Running: {escape(tool_call['function']['name'])}...[/cyan]")
+                                    future = executor.submit(call_tool, tools_map, tool_call)
+                                    in_flight.append(future)
+                                started[key] = future
+                                futures.append(future)
                             
-                            # Add tool result to messages
-                            messages.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call["id"],
-                                "content": json.dumps(result)
-                            })
-
-                        print("\033[96m🤔 Melon is thinking about the results...\033[0m")
+                            results = []
+                            for tool_call, future in zip(tool_calls_list, futures):
+                                result = future.result()
+                                results.append(result)
+                                console.print("[cyan]✅ Done![/cyan]")
+                                
+                                # Add tool result to messages
+                                messages.append({
+                                    "role": "tool",
+                                    "tool_call_id": tool_call["id"],
+                                    "content": tool_message_content(result, tool_call["id"])
+                                })
+
+                        # The model already explained itself and every command succeeded
+                        # silently, so skip the follow-up turn that would only confirm it
+                        if FAST_ACK and content and all(is_silent_success(r) for r in results):
+                            console.print("[green]✓ done[/green]")
+                            messages.append({"role": "assistant", "content": "Done."})
+                            break
+
+                        console.print("[cyan]🤔 Melon is thinking about the results...[/cyan]")
                         iteration += 1
                     else:
                         # No more tool calls, we have a final response
@@ -1637,20 +2887,19 @@ def main():
 
                 # Check if we hit max iterations
                 if iteration >= max_iterations:
-                    print("\033[93m⚠️  Maximum iteration limit reached. Melon tried to make too many tool calls in succession.\033[0m")
+                    console.print("[yellow]⚠️  Maximum iteration limit reached. Melon tried to make too many tool calls in succession.[/yellow]")
                 # Check if response has content
                 elif content:
                     # Content was already displayed during streaming, no need to print again
                     pass
                 else:
-                    print("\033[93m⚠️  Melon didn't have anything to say. This might be due to rate limiting or an API issue.\033[0m")
+                    console.print("[yellow]⚠️  Melon didn't have anything to say. This might be due to rate limiting or an API issue.[/yellow]")
                 
                 # Save conversation history after each successful interaction
                 # Skip the system message when saving (it's always added on load)
                 
                 # Check if this is the first message in a new unsaved chat
-                user_message_count = len([m for m in messages if m.get("role") == "user"])
-                if is_new_unsaved_chat and user_message_count >= 1:
+                if is_new_unsaved_chat and has_user_messages(messages):
                     # This is the first successful response - use helper to save with error handling
                     success, chat_name, error = save_unsaved_chat(is_new_unsaved_chat, messages, client, settings)
                     if success:
@@ -1668,13 +2917,12 @@ def main():
                     # Regular save to existing chat
                     save_history(messages[1:], active_chat)
             except Exception as e:
-                print(f"\033[91m❌ Error: {e}\033[0m")
-                import traceback
-                print(f"\033[90m{traceback.format_exc()}\033[0m")
+                console.print(f"[red]❌ Error: {escape(str(e))}[/red]")
+                console.print(f"[dim]{escape(traceback.format_exc())}[/dim]")
 
-            print("\033[90m" + "─" * 60 + "\033[0m\n")
+            console.print(SEPARATOR)
         except KeyboardInterrupt:
-            print("\n\033[92m👋 Thanks for using Melon!\033[0m")
+            console.print("\n[green]👋 Thanks for using Melon![/green]")
             break
 
 if __name__ == "__main__":
@@ -14,5 +14,6 @@ setup(
         "python-dotenv",
         "rich",
         "prompt_toolkit",
+        "httpx[http2]",
     ],
 )
\ No newline at end of file